@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# A local stand-in for API3, serving synthetic report payloads for any
+# /v3/accounts/<cid>/... request. Responses are deterministic per (cid, path),
+# and rows drift between the "before" and "after" phases.
+
+import json
+import multiprocessing
+import random
+import sys
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockOptions:
+    def __init__(
+        self,
+        rows=100,
+        latency_ms=20,
+        error_rate=0.0,
+        unauthorized_rate=0.0,
+        drift=0.05,
+    ):
+        self.rows = rows
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.unauthorized_rate = unauthorized_rate
+        self.drift = drift
+
+
+def synthetic_response(cid, path, rows, drift, phase):
+    generator = random.Random(f"{cid}:{path}")
+    data = []
+    for index in range(rows):
+        count = generator.randint(0, 10000)
+        amount = round(generator.uniform(0, 1000), 2)
+        # Rows drift in the after phase, the same rows on every request
+        if (
+            phase == "after"
+            and zlib.crc32(f"{cid}:{path}:{index}".encode()) % 10000 < drift * 10000
+        ):
+            count = int(count * 1.1) + 1
+            amount = round(amount * 0.9, 2)
+        data.append(
+            {
+                "id": index,
+                "date": f"2024-01-{index % 28 + 1:02d}",
+                "count": count,
+                "amount": amount,
+                "label": f"row-{index}",
+            }
+        )
+    return {"data": data, "total_results": rows}
+
+
+def make_handler(options, state):
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def read_body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        def handle_api_call(self):
+            time.sleep(options.latency_ms / 1000)
+            if random.random() < options.unauthorized_rate:
+                return self.send_json(401, {"error": "token expired"})
+            if random.random() < options.error_rate:
+                return self.send_json(500, {"error": "internal error"})
+            cid = self.path.split("/")[3]
+            self.send_json(
+                200,
+                synthetic_response(
+                    cid, self.path, options.rows, options.drift, state["phase"]
+                ),
+            )
+
+        def do_GET(self):
+            self.handle_api_call()
+
+        def do_POST(self):
+            self.read_body()
+            if self.path == "/oauth2/token":
+                return self.send_json(
+                    200,
+                    {
+                        "access_token": f"mock-token-{time.time()}",
+                        "refresh_token": "mock-refresh-token",
+                        "expires_in": 3600,
+                    },
+                )
+            if self.path.startswith("/__phase/"):
+                state["phase"] = self.path.split("/")[-1]
+                return self.send_json(200, {"phase": state["phase"]})
+            self.handle_api_call()
+
+    return MockHandler
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop keep-alive connections when they give up on a response
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(options, port_queue, port=0):
+    state = {"phase": "before"}
+    server = MockServer(("127.0.0.1", port), make_handler(options, state))
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_mock_server(options, port=0):
+    # Runs in its own process so it does not compete with the tool for the GIL
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=serve, args=(options, port_queue, port), daemon=True
+    )
+    process.start()
+    return process, f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+
+if __name__ == "__main__":
+    import typer
+
+    def main(
+        port: int = typer.Option(5323, help="Port to listen on"),
+        rows: int = typer.Option(100, help="Rows per response"),
+        latency_ms: int = typer.Option(20, help="Added latency per request"),
+        error_rate: float = typer.Option(0.0, help="Fraction of 500 responses"),
+        unauthorized_rate: float = typer.Option(0.0, help="Fraction of 401s"),
+        drift: float = typer.Option(0.05, help="Fraction of rows changed in 'after'"),
+    ):
+        options = MockOptions(rows, latency_ms, error_rate, unauthorized_rate, drift)
+        typer.echo(f"Serving mock API3 on http://127.0.0.1:{port}")
+        serve(options, multiprocessing.Queue(), port)
+
+    typer.run(main)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Drives run_test_tool end to end against the local mock API3 server with a
+# synthetic CID x endpoint matrix, and reports throughput, per-stage latency
+# percentiles from the run's metrics.json, and peak RSS. Results are saved as
+# JSON so runs can be compared.
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import typer
+
+from mock_api3 import MockOptions, start_mock_server
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# Stages reported from metrics.json, by their histogram names
+STAGES = {
+    "fetch": "fetch_seconds",
+    "request": "request_seconds",
+    "store": "store_write_seconds",
+    "commit": "store_commit_seconds",
+    "diff": "diff_seconds",
+    "before_phase": 'phase_seconds{phase="before"}',
+    "after_phase": 'phase_seconds{phase="after"}',
+    "compare_phase": 'phase_seconds{phase="compare"}',
+    "summarize": 'phase_seconds{phase="summarize"}',
+}
+
+
+def stage_summary(run_metrics):
+    summary = {}
+    for stage, name in STAGES.items():
+        histogram = run_metrics.get(name)
+        if not histogram or not histogram["count"]:
+            continue
+        summary[stage] = {
+            "count": histogram["count"],
+            "total_ms": histogram["sum"] * 1000,
+            "mean_ms": histogram["mean"] * 1000,
+            "p50_ms": histogram["p50"] * 1000,
+            "p90_ms": histogram["p90"] * 1000,
+            "p99_ms": histogram["p99"] * 1000,
+            "max_ms": histogram["max"] * 1000,
+        }
+    return summary
+
+
+def write_config(work_dir, cids, endpoints, comparator):
+    calls = []
+    for index in range(endpoints):
+        call = {"url": f"reports/endpoint_{index}?window=30d", "method": "GET"}
+        if comparator == "numeric":
+            call.update({"comparator": "numeric", "align_key": "id"})
+        calls.append(call)
+    config_path = os.path.join(work_dir, "bench_config.json")
+    with open(config_path, "w") as f:
+        json.dump({"cids": [str(1000 + i) for i in range(cids)], "calls": calls}, f)
+    return config_path
+
+
+def run_benchmark(
+    cids=20,
+    endpoints=10,
+    rows=100,
+    latency_ms=20,
+    error_rate=0.0,
+    unauthorized_rate=0.0,
+    drift=0.05,
+    concurrency=8,
+    diff_workers=1,
+    pipeline_compare=False,
+    comparator="deepdiff",
+    summary_type="endpoint",
+    quiet=True,
+    diff_cache_size=0,
+):
+    options = MockOptions(rows, latency_ms, error_rate, unauthorized_rate, drift)
+    server, base_url = start_mock_server(options)
+    work_dir = tempfile.mkdtemp(prefix="api3_bench_")
+
+    # Point the tool at the mock server and a throwaway token file. This has
+    # to happen before its modules are imported.
+    tokens_file = os.path.join(work_dir, "tokens.yaml")
+    with open(tokens_file, "w") as f:
+        f.write("dev:\n  auth_token: mock-token\n  refresh_token: mock-refresh-token\n")
+    os.environ["API3_BASE_URL"] = base_url
+    os.environ["API3_TOKENS_FILE"] = tokens_file
+    sys.path.insert(0, os.path.abspath(SRC_DIR))
+    import main
+    from sessions import get_session
+
+    # Tell the mock server which phase it is serving, so "after" drifts
+    execute_api_calls = main.execute_api_calls
+
+    def execute_phase(cids, calls, base_url, run_order, *args, **kwargs):
+        get_session(base_url).post(f"{base_url}/__phase/{run_order}")
+        return execute_api_calls(cids, calls, base_url, run_order, *args, **kwargs)
+
+    main.execute_api_calls = execute_phase
+
+    config_path = write_config(work_dir, cids, endpoints, comparator)
+    run_dir = os.path.join(work_dir, "run")
+    output = open(os.devnull, "w") if quiet else sys.stdout
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        main.run_test_tool(
+            "dev",
+            config_path,
+            run_dir,
+            summary_type,
+            True,
+            concurrency,
+            diff_workers=diff_workers,
+            pipeline_compare=pipeline_compare,
+            headless=True,
+            diff_cache_size=diff_cache_size,
+        )
+    wall_seconds = time.perf_counter() - start
+
+    # Measured before the mock server exits, so only the diff workers count
+    peak_rss = {
+        "self_mb": peak_rss_mb(resource.RUSAGE_SELF),
+        "children_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+    server.terminate()
+
+    with open(os.path.join(run_dir, "results.json")) as f:
+        total_diffs = json.load(f)["total_diffs"]
+    with open(os.path.join(run_dir, "metrics.json")) as f:
+        run_metrics = json.load(f)
+
+    stages = stage_summary(run_metrics)
+    requests = 2 * cids * endpoints
+    fetch_seconds = sum(
+        stages.get(phase, {}).get("total_ms", 0) / 1000
+        for phase in ["before_phase", "after_phase"]
+    )
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "parameters": {
+            "cids": cids,
+            "endpoints": endpoints,
+            "rows": rows,
+            "latency_ms": latency_ms,
+            "error_rate": error_rate,
+            "unauthorized_rate": unauthorized_rate,
+            "drift": drift,
+            "concurrency": concurrency,
+            "diff_workers": diff_workers,
+            "pipeline_compare": pipeline_compare,
+            "comparator": comparator,
+            "summary_type": summary_type,
+            "diff_cache_size": diff_cache_size,
+        },
+        "wall_seconds": wall_seconds,
+        "requests": requests,
+        "throughput_rps": requests / fetch_seconds if fetch_seconds else None,
+        "total_diffs": total_diffs,
+        "stages": stages,
+        "metrics": run_metrics,
+        "peak_rss": peak_rss,
+        "run_dir": run_dir,
+    }
+
+
+def main(
+    cids: int = typer.Option(20, help="Number of synthetic CIDs"),
+    endpoints: int = typer.Option(10, help="Number of synthetic endpoints"),
+    rows: int = typer.Option(100, help="Rows per response"),
+    latency_ms: int = typer.Option(20, help="Server latency per request"),
+    error_rate: float = typer.Option(0.0, help="Fraction of 500 responses"),
+    unauthorized_rate: float = typer.Option(0.0, help="Fraction of 401 responses"),
+    drift: float = typer.Option(0.05, help="Fraction of rows changed in 'after'"),
+    concurrency: int = typer.Option(8, help="--concurrency for the run"),
+    diff_workers: int = typer.Option(1, help="--diff-workers for the run"),
+    pipeline_compare: bool = typer.Option(False, help="--pipeline-compare"),
+    comparator: str = typer.Option("deepdiff", help="'deepdiff' or 'numeric'"),
+    summary_type: str = typer.Option("endpoint", help="--summary-type"),
+    output: str = typer.Option("", help="Where to save the results JSON"),
+    quiet: bool = typer.Option(True, help="Hide the tool's own output"),
+    diff_cache_size: int = typer.Option(
+        0, help="--diff-cache-size (off by default, so runs are comparable)"
+    ),
+):
+    result = run_benchmark(
+        cids,
+        endpoints,
+        rows,
+        latency_ms,
+        error_rate,
+        unauthorized_rate,
+        drift,
+        concurrency,
+        diff_workers,
+        pipeline_compare,
+        comparator,
+        summary_type,
+        quiet,
+        diff_cache_size,
+    )
+
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"bench_{int(time.time())}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=4)
+
+    typer.echo(
+        f"{result['requests']} requests in {result['wall_seconds']:.2f}s "
+        f"({result['throughput_rps'] or 0:.1f} req/s while fetching), "
+        f"{result['total_diffs']} pairs with diffs"
+    )
+    for stage, stats in result["stages"].items():
+        typer.echo(
+            f"  {stage:<14} n={stats['count']:<6} p50={stats['p50_ms']:.1f}ms "
+            f"p90={stats['p90_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms"
+        )
+    typer.echo(
+        f"  peak RSS: {result['peak_rss']['self_mb']:.0f} MB "
+        f"(diff workers {result['peak_rss']['children_mb']:.0f} MB)"
+    )
+    typer.echo(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
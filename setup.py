@@ -12,12 +12,19 @@ setup(
         "python-dotenv==1.0.1",
         "PyYAML==6.0.1",
         "rich==13.7.1",
+        "numpy==1.24.4",
     ],
     extras_require={
         "dev": [
             "black==24.3.0",
             "mypy-extensions==1.0.0",
         ],
+        "zstd": [
+            "zstandard==0.22.0",
+        ],
+        "fast": [
+            "orjson==3.10.3",
+        ],
     },
     entry_points={
         "console_scripts": [
@@ -1,9 +1,33 @@
+import random
 import requests
 import time
+from email.utils import parsedate_to_datetime
 from auth import get_auth_token
+from metrics import metrics
 from output import c_print
+from rate_limit import get_rate_limiter
+from sessions import get_session
 
 max_retries = 2
+backoff_base = 1
+backoff_cap = 30
+
+
+def retry_delay(attempt, response=None):
+    # Honor Retry-After (seconds or an HTTP date) when the server sends one
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(
+                    0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()
+                )
+            except (TypeError, ValueError):
+                pass
+    # Otherwise exponential backoff with full jitter
+    return random.uniform(0, min(backoff_cap, backoff_base * 2**attempt))
 
 
 def make_api_call(
@@ -13,44 +37,77 @@ def make_api_call(
     body=None,
     base_url="",
     env="prod",
-    retry=0,
+    consume=None,
 ):
-    # Include the bearer token in headers
-    token = get_auth_token(env)
-    if not headers:
-        headers = {}
-    headers["Authorization"] = f"Bearer {token}"
+    # consume, if given, reads a successful response in place of
+    # response.json(). The body is then streamed, and read inside the retry
+    # loop, so a body that fails to arrive or to parse is retried like any
+    # other failed request.
+    headers = dict(headers or {})
     headers["Content-Type"] = "application/json"
 
     full_url = f"{base_url}{url}"
+    session = get_session(base_url)
+    rate_limiter = get_rate_limiter(env)
+
+    for attempt in range(max_retries + 1):
+        # Include the bearer token in headers
+        token = get_auth_token(env)
+        headers["Authorization"] = f"Bearer {token}"
+
+        rate_limiter.acquire()
+        response = None
+        start = time.perf_counter()
+        try:
+            if method == "GET":
+                response = session.get(
+                    full_url, headers=headers, stream=consume is not None
+                )
+            elif method == "POST":
+                response = session.post(
+                    full_url, json=body, headers=headers, stream=consume is not None
+                )
+            else:
+                raise ValueError(f"Unsupported method {method}")
+            # Time to the response headers; streamed bodies are read later
+            metrics.histogram("request_seconds").observe(time.perf_counter() - start)
+            metrics.counter("requests_total", status=response.status_code).inc()
+            response.raise_for_status()
+            if consume is None:
+                return response.json()
+            try:
+                return consume(response)
+            finally:
+                response.close()
+        except requests.exceptions.RequestException as e:
+            c_print.fail(f"Request failed: {e}")
+            status_code = response.status_code if response is not None else None
+            if response is not None:
+                response.close()
+            else:
+                metrics.counter("requests_total", status="error").inc()
+
+            # if the response is a 404, no retry (resource doesn't exist)
+            if status_code == 404 or attempt == max_retries:
+                metrics.counter("failed_requests_total").inc()
+                return None
+            metrics.counter("request_retries_total").inc()
+
+            # if the response is a 401, refresh the auth token and retry
+            if status_code == 401:
+                metrics.counter("unauthorized_responses_total").inc()
+                c_print.warn("Refreshing auth token")
+                get_auth_token(env, refresh=True, stale_token=token)
+                continue
+
+            # Otherwise, back off and retry the request. Throttling responses
+            # hold back every worker for this env, not just this one.
+            delay = retry_delay(attempt, response)
+            if status_code in (429, 503):
+                metrics.counter("throttled_responses_total").inc()
+                c_print.warn(f"Throttled, backing off for {delay:.1f}s")
+                rate_limiter.hold(delay)
+            else:
+                time.sleep(delay)
 
-    try:
-        if method == "GET":
-            response = requests.get(full_url, headers=headers)
-        elif method == "POST":
-            response = requests.post(full_url, json=body, headers=headers)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        c_print.fail(f"Request failed: {e}")
-        # if the response is a 404, no retry (resource doesn't exist)
-        if response.status_code == 404:
-            return None
-
-        # if the response is a 401, refresh the auth token and retry
-        if response.status_code == 401:
-            c_print.warn("Refreshing auth token")
-            get_auth_token(env, refresh=True)
-            return (
-                make_api_call(url, method, headers, body, base_url, env, retry + 1)
-                if retry < max_retries
-                else None
-            )
-
-        # Otherwise, retry the request if it failed
-        time.sleep(2)
-        return (
-            make_api_call(url, method, headers, body, base_url, env, retry + 1)
-            if retry < max_retries
-            else None
-        )
+    return None
@@ -1,7 +1,12 @@
+import base64
+import json
 import os
-import requests
+import threading
+import time
 import yaml
+from metrics import metrics
 from output import c_print
+from sessions import get_session
 from getpass import getpass
 from utils import get_url_from_env
 from dotenv import load_dotenv
@@ -10,7 +15,36 @@ from dotenv import load_dotenv
 # every environment. Figure out how it works in the ruby client and mimic
 # that behavior.
 
-CONF_FILE = os.path.expanduser("~/.api3_tokens.yaml")
+CONF_FILE = os.getenv("API3_TOKENS_FILE") or os.path.expanduser("~/.api3_tokens.yaml")
+
+# Tokens are refreshed this many seconds before they expire
+REFRESH_MARGIN = 60
+
+MAX_AUTH_ATTEMPTS = 3
+
+# Set by configure_headless. A headless run never prompts: the TOTP comes from
+# API3_TOTP or a file, and a pre-issued token from API3_TOKEN or a file can
+# stand in for logging in at all.
+_headless = False
+_totp_file = ""
+_token_file = ""
+
+
+def configure_headless(headless, totp_file="", token_file=""):
+    global _headless, _totp_file, _token_file
+    _headless = headless
+    _totp_file = totp_file
+    _token_file = token_file
+
+
+def read_secret(env_var, path=""):
+    # Files are read again on every call, so a rotated secret is picked up
+    if os.getenv(env_var):
+        return os.getenv(env_var).strip()
+    if path:
+        with open(path, "r") as file:
+            return file.read().strip()
+    return ""
 
 
 def read_conf():
@@ -20,20 +54,45 @@ def read_conf():
     return {}
 
 
-def write_conf(env, data):
-    if os.path.exists(CONF_FILE):
-        with open(CONF_FILE, "r") as file:
-            conf_data = yaml.safe_load(file)
-        conf_data[env] = data
-    else:
-        conf_data = {env: data}
+def write_conf(conf_data):
     with open(CONF_FILE, "w") as file:
         yaml.dump(conf_data, file, default_flow_style=False)
 
 
+def jwt_expiry(token):
+    # The exp claim of a JWT, without verifying it; None for other tokens
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(
+            base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        )
+        return float(claims["exp"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def token_credentials(data):
+    # What is kept of an /oauth2/token response. expires_at is a timestamp,
+    # from expires_in or else the token's own exp claim.
+    expires_at = None
+    if data.get("expires_in"):
+        expires_at = time.time() + float(data["expires_in"])
+    return {
+        "auth_token": data["access_token"],
+        "refresh_token": data.get("refresh_token"),
+        "expires_at": expires_at or jwt_expiry(data["access_token"]),
+    }
+
+
+def token_expires_at(credentials):
+    # Tokens saved by older versions have no expires_at
+    return credentials.get("expires_at") or jwt_expiry(credentials.get("auth_token"))
+
+
 def refresh_auth(refresh_token, env):
+    # Returns None once the refresh token is no longer accepted
     endpoint = get_url_from_env(env)
-    response = requests.post(
+    response = get_session(endpoint).post(
         f"{endpoint}/oauth2/token",
         data={
             "grant_type": "refresh_token",
@@ -44,68 +103,170 @@ def refresh_auth(refresh_token, env):
     )
     if response.status_code < 300:
         c_print.cyan("Refreshed auth token")
-        data = response.json()
-        auth_token = data["access_token"]
-        refresh_token = data.get("refresh_token")
-        write_conf(env, {"auth_token": auth_token, "refresh_token": refresh_token})
-        return auth_token
-    else:
-        c_print.warn("Refresh token has expired, please authenticate again.")
-        return password_auth(env)
+        return token_credentials(response.json())
+    c_print.warn("Refresh token has expired, please authenticate again.")
+    return None
 
 
 def password_auth(env):
-    # Check if username and password are in environment variables
-    load_dotenv()
-    username = os.getenv("USERNAME")
-    password = os.getenv("PASSWORD")
-    if not username or not password:
-        # If not, prompt user for username and password
-        username = input("Username: ")
-        password = getpass("Password: ")
-    else:
-        c_print.cyan(
-            f"Using username and password {username} from environment variable"
-        )
-    # Ask for TOTP token
-    totp = getpass("Token: ")
-
     endpoint = get_url_from_env(env)
-    response = requests.post(
-        f"{endpoint}/oauth2/token",
-        data={
-            "grant_type": "password",
-            "username": username,
-            "password": password,
-            "totp": totp,
-            "response_type": "token",
-            "client_id": "api3_comparator",
-        },
-    )
-    if response.status_code < 300:
-        c_print.ok("Authentication successful")
-        data = response.json()
-        write_conf(
-            env,
-            {
-                "auth_token": data["access_token"],
-                "refresh_token": data.get("refresh_token"),
+    for _ in range(MAX_AUTH_ATTEMPTS):
+        # Check if username and password are in environment variables
+        load_dotenv()
+        username = os.getenv("USERNAME")
+        password = os.getenv("PASSWORD")
+        if not username or not password:
+            if _headless:
+                raise RuntimeError(
+                    "Headless runs need USERNAME and PASSWORD in the environment or .env"
+                )
+            # If not, prompt user for username and password
+            username = input("Username: ")
+            password = getpass("Password: ")
+        else:
+            c_print.cyan(
+                f"Using username and password {username} from environment variable"
+            )
+        # Ask for TOTP token, unless one was provided
+        totp = read_secret("API3_TOTP", _totp_file)
+        if not totp:
+            if _headless:
+                raise RuntimeError("Headless runs need API3_TOTP or --totp-file")
+            totp = getpass("Token: ")
+
+        response = get_session(endpoint).post(
+            f"{endpoint}/oauth2/token",
+            data={
+                "grant_type": "password",
+                "username": username,
+                "password": password,
+                "totp": totp,
+                "response_type": "token",
+                "client_id": "api3_comparator",
             },
         )
-        return data["access_token"]
-    else:
+        if response.status_code < 300:
+            c_print.ok("Authentication successful")
+            return token_credentials(response.json())
         c_print.fail("Failed to authenticate")
-        return password_auth(env)
+        if _headless:
+            # The same TOTP would only be rejected again
+            raise RuntimeError("Failed to authenticate with the provided credentials")
+    raise RuntimeError(f"Failed to authenticate after {MAX_AUTH_ATTEMPTS} attempts")
+
+
+class TokenManager:
+    # Holds the tokens for every environment in memory, so CONF_FILE is read
+    # once per process and only written when a token actually changes. All
+    # access goes through one lock, which also makes refreshes single-flight.
+    # Tokens are refreshed shortly before they expire: in the background
+    # where there is a refresh token, otherwise by the next get_token.
+    def __init__(self):
+        self._conf = None
+        self._lock = threading.Lock()
+        self._timers = {}
+        # (token file, token) for the pre-issued token, if any
+        self._issued = None
+
+    def _credentials(self, env):
+        if self._conf is None:
+            self._conf = read_conf() or {}
+        return self._conf.get(env) or {}
+
+    def _save(self, env, credentials):
+        if self._credentials(env) == credentials:
+            return
+        self._conf[env] = credentials
+        write_conf(self._conf)
+
+    def _renew(self, env, credentials, log_in=True):
+        metrics.counter("token_refreshes_total").inc()
+        renewed = None
+        if credentials.get("refresh_token"):
+            renewed = refresh_auth(credentials["refresh_token"], env)
+        if renewed is None:
+            if not log_in:
+                raise RuntimeError("The refresh token was rejected")
+            renewed = password_auth(env)
+        self._save(env, renewed)
+        self._schedule_refresh(env, renewed)
+        return renewed["auth_token"]
+
+    def _schedule_refresh(self, env, credentials):
+        # Only with a refresh token: logging in again may need someone at the
+        # keyboard, which a background thread cannot ask for
+        timer = self._timers.pop(env, None)
+        if timer:
+            timer.cancel()
+        expires_at = token_expires_at(credentials)
+        if expires_at is None or not credentials.get("refresh_token"):
+            return
+        timer = threading.Timer(
+            max(0, expires_at - REFRESH_MARGIN - time.time()),
+            self._refresh_in_background,
+            (env, credentials["auth_token"]),
+        )
+        timer.daemon = True
+        self._timers[env] = timer
+        timer.start()
+
+    def _refresh_in_background(self, env, token):
+        try:
+            with self._lock:
+                # Already refreshed, e.g. after a 401
+                if self._credentials(env).get("auth_token") != token:
+                    return
+                self._renew(env, self._credentials(env), log_in=False)
+        except Exception as e:
+            c_print.warn(f"Background token refresh failed: {e}")
+
+    def _issued_token(self, reread=False):
+        # Read once, not on every request; refresh() re-reads it, so a
+        # rotated token is picked up after a 401
+        if reread or self._issued is None or self._issued[0] != _token_file:
+            self._issued = (_token_file, read_secret("API3_TOKEN", _token_file))
+        return self._issued[1]
+
+    def get_token(self, env):
+        with self._lock:
+            issued_token = self._issued_token()
+            if issued_token:
+                return issued_token
+            credentials = self._credentials(env)
+            if credentials.get("auth_token") and credentials.get("refresh_token"):
+                expires_at = token_expires_at(credentials)
+                if expires_at is not None and expires_at - time.time() < REFRESH_MARGIN:
+                    return self._renew(env, credentials)
+                # A timer inherited from a forked parent does not run here
+                timer = self._timers.get(env)
+                if not (timer and timer.is_alive()):
+                    self._schedule_refresh(env, credentials)
+                return credentials["auth_token"]
+            credentials = password_auth(env)
+            self._save(env, credentials)
+            self._schedule_refresh(env, credentials)
+            return credentials["auth_token"]
+
+    def refresh(self, env, stale_token=None):
+        with self._lock:
+            # Pre-issued tokens are never stored or refreshed here, but the
+            # file they come from may have been rotated in the meantime
+            issued_token = self._issued_token(reread=True)
+            if issued_token:
+                if issued_token == stale_token:
+                    raise RuntimeError("The pre-issued API3 token was rejected")
+                return issued_token
+            credentials = self._credentials(env)
+            # Another worker already refreshed while we were waiting on the lock
+            if stale_token and credentials.get("auth_token") != stale_token:
+                return credentials["auth_token"]
+            return self._renew(env, credentials)
+
 
+token_manager = TokenManager()
 
-def get_auth_token(env, refresh=False):
-    conf = read_conf()
-    auth_token = conf.get(env, {}).get("auth_token")
-    refresh_token = conf.get(env, {}).get("refresh_token")
 
-    if auth_token and refresh_token:
-        if refresh:
-            return refresh_auth(refresh_token, env)
-        return auth_token
-    else:
-        return password_auth(env)
+def get_auth_token(env, refresh=False, stale_token=None):
+    if refresh:
+        return token_manager.refresh(env, stale_token)
+    return token_manager.get_token(env)
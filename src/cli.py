@@ -1,14 +1,60 @@
 #!/usr/bin/env python3
 
 import typer
+from typing import List
 import os
+import json
 from main import run_test_tool
+from snapshot import (
+    take_snapshot,
+    take_local_shards,
+    merge_snapshots,
+    compare_snapshots,
+)
+from merge import merge_runs
+from recompare import recompare_run
+from daemon import serve as serve_jobs, DEFAULT_PORT
+from shards import parse_shard
+from db import ResponseStore, DEFAULT_BATCH_SIZE
+from sessions import DEFAULT_POOL_SIZE, close_sessions
+from diff_cache import DEFAULT_CACHE_SIZE_MB
+from synthesize_results import THRESHOLD
+
+app = typer.Typer()
 
 
 def validate_inputs(
-    env: str, config_path: str, output_dir: str, summary_type: str, skip_pause: bool
+    env: str,
+    config_path: str,
+    output_dir: str,
+    summary_type: str,
+    skip_pause: bool,
+    concurrency: int = 1,
+    pool_size: int = 0,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    diff_workers: int = 0,
+    pipeline_compare: bool = False,
+    resume: str = "",
+    rate_limit: float = 0.0,
+    burst: int = 0,
+    prometheus_textfile: str = "",
+    headless: bool = False,
+    totp_file: str = "",
+    token_file: str = "",
+    pause_hook: str = "",
+    pause_trigger_file: str = "",
+    pause_health_url: str = "",
+    pause_timeout: int = 0,
+    shard: str = "",
+    diff_cache_size: int = DEFAULT_CACHE_SIZE_MB,
 ):
-    if env not in ["dev", "expr", "stg1", "prod"]:
+    if resume:
+        for run_file in ["config.json", "responses.db"]:
+            if not os.path.isfile(os.path.join(resume, run_file)):
+                raise FileNotFoundError(
+                    f"Cannot resume: '{run_file}' does not exist in '{resume}'."
+                )
+    elif env not in ["dev", "expr", "stg1", "prod"]:
         raise ValueError(
             "Invalid environment. Please choose one of 'dev', 'stg1', 'expr', or 'prod'."
         )
@@ -20,8 +66,39 @@ def validate_inputs(
         )
     if not isinstance(skip_pause, bool):
         raise ValueError("skip_pause must be a boolean value.")
+    if not isinstance(pipeline_compare, bool):
+        raise ValueError("pipeline_compare must be a boolean value.")
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1.")
+    if pool_size < 0:
+        raise ValueError("pool_size must not be negative.")
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1.")
+    if diff_workers < 0:
+        raise ValueError("diff_workers must not be negative.")
+    if rate_limit < 0 or burst < 0:
+        raise ValueError("rate_limit and burst must not be negative.")
+    if prometheus_textfile and not os.path.isdir(
+        os.path.dirname(os.path.abspath(prometheus_textfile))
+    ):
+        raise FileNotFoundError(
+            f"Directory for '{prometheus_textfile}' does not exist."
+        )
+    if headless and not (config_path or resume):
+        raise ValueError("Headless runs need --config-path or --resume.")
+    for secret_file in [totp_file, token_file]:
+        if secret_file and not os.path.isfile(secret_file):
+            raise FileNotFoundError(f"Secret file '{secret_file}' does not exist.")
+    if pause_timeout < 0:
+        raise ValueError("pause_timeout must not be negative.")
+    if shard and resume:
+        raise ValueError("A resumed run keeps its own shard; drop --shard.")
+    parse_shard(shard)
+    if diff_cache_size < 0:
+        raise ValueError("diff_cache_size must not be negative.")
 
 
+@app.command(help="Snapshot, pause for the change, snapshot again and compare")
 def start(
     env: str = typer.Option("", help="Environment (dev/expr/stg1/prod)"),
     config_path: str = typer.Option("", help="Path to the config.json file"),
@@ -31,13 +108,117 @@ def start(
     ),
     skip_pause: bool = typer.Option(False, help="Do not pause in between runs"),
     setup_env: bool = typer.Option(False, help="Run setup for making .env file"),
+    concurrency: int = typer.Option(
+        1, help="Number of API calls to have in flight at once"
+    ),
+    pool_size: int = typer.Option(
+        0, help="Keep-alive connections per host (defaults to --concurrency)"
+    ),
+    batch_size: int = typer.Option(
+        DEFAULT_BATCH_SIZE, help="Number of stored responses per db commit"
+    ),
+    diff_workers: int = typer.Option(
+        0, help="Processes used to diff responses (0 uses every core)"
+    ),
+    pipeline_compare: bool = typer.Option(
+        False, help="Diff 'after' responses while the phase is still running"
+    ),
+    resume: str = typer.Option(
+        "", help="Run directory of an interrupted run to pick up where it left off"
+    ),
+    rate_limit: float = typer.Option(
+        0.0, help="Maximum requests per second to the environment (0 for no limit)"
+    ),
+    burst: int = typer.Option(
+        0, help="Requests allowed in a burst above --rate-limit (defaults to it)"
+    ),
+    prometheus_textfile: str = typer.Option(
+        "", help="Also write the run's metrics to this Prometheus textfile"
+    ),
+    headless: bool = typer.Option(
+        False, help="Never prompt; needs --config-path and credentials from env/files"
+    ),
+    totp_file: str = typer.Option(
+        "", help="File holding the TOTP (API3_TOTP also works)"
+    ),
+    token_file: str = typer.Option(
+        "", help="File holding a pre-issued API3 token (API3_TOKEN also works)"
+    ),
+    pause_hook: str = typer.Option(
+        "", help="Shell command to run between phases instead of pausing"
+    ),
+    pause_trigger_file: str = typer.Option(
+        "", help="Pause between phases until this file is created or touched"
+    ),
+    pause_health_url: str = typer.Option(
+        "", help="Pause between phases until this URL answers 2xx"
+    ),
+    pause_timeout: int = typer.Option(
+        0, help="Seconds to wait on pause hooks before failing (0 waits forever)"
+    ),
+    shard: str = typer.Option(
+        "", help="Only run shard i/N of the cid x call matrix, e.g. 2/4"
+    ),
+    diff_cache_size: int = typer.Option(
+        DEFAULT_CACHE_SIZE_MB,
+        help="Size in MB of the diff cache shared by all runs (0 turns it off)",
+    ),
 ):
-    validate_inputs(env, config_path, output_dir, summary_type, skip_pause)
+    validate_inputs(
+        env,
+        config_path,
+        output_dir,
+        summary_type,
+        skip_pause,
+        concurrency,
+        pool_size,
+        batch_size,
+        diff_workers,
+        pipeline_compare,
+        resume,
+        rate_limit,
+        burst,
+        prometheus_textfile,
+        headless,
+        totp_file,
+        token_file,
+        pause_hook,
+        pause_trigger_file,
+        pause_health_url,
+        pause_timeout,
+        shard,
+        diff_cache_size,
+    )
     if setup_env:
         setup_env()
-    run_test_tool(env, config_path, output_dir, summary_type, skip_pause)
+    run_test_tool(
+        env,
+        config_path,
+        output_dir,
+        summary_type,
+        skip_pause,
+        concurrency,
+        pool_size,
+        batch_size,
+        diff_workers,
+        pipeline_compare,
+        resume,
+        rate_limit,
+        burst,
+        prometheus_textfile,
+        headless,
+        totp_file,
+        token_file,
+        pause_hook,
+        pause_trigger_file,
+        pause_health_url,
+        pause_timeout,
+        shard,
+        diff_cache_size,
+    )
 
 
+@app.command("setup-env", help="Save console credentials to a .env file")
 def setup_env(
     username: str = typer.Option(..., prompt=True, help="Username for the .env file"),
     password: str = typer.Option(
@@ -50,5 +231,355 @@ def setup_env(
     typer.echo("Environment variables saved to .env file.")
 
 
+def validate_snapshot_inputs(
+    env: str,
+    config_path: str,
+    output: str,
+    concurrency: int = 1,
+    pool_size: int = 0,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    rate_limit: float = 0.0,
+    burst: int = 0,
+    totp_file: str = "",
+    token_file: str = "",
+    shard: str = "",
+    local_shards: int = 0,
+):
+    # An existing snapshot file is resumed with its own env and config
+    if not os.path.exists(output):
+        if env not in ["dev", "expr", "stg1", "prod"]:
+            raise ValueError(
+                "Invalid environment. Please choose one of 'dev', 'stg1', 'expr', or 'prod'."
+            )
+        if not os.path.isfile(config_path):
+            raise FileNotFoundError(f"Config file '{config_path}' does not exist.")
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1.")
+    if pool_size < 0:
+        raise ValueError("pool_size must not be negative.")
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1.")
+    if rate_limit < 0 or burst < 0:
+        raise ValueError("rate_limit and burst must not be negative.")
+    for secret_file in [totp_file, token_file]:
+        if secret_file and not os.path.isfile(secret_file):
+            raise FileNotFoundError(f"Secret file '{secret_file}' does not exist.")
+    parse_shard(shard)
+    if local_shards < 0:
+        raise ValueError("local_shards must not be negative.")
+    if shard and local_shards:
+        raise ValueError("Use either --shard or --local-shards, not both.")
+    if local_shards and os.path.exists(output):
+        raise FileExistsError(f"'{output}' already exists.")
+
+
+@app.command(help="Capture one phase of responses to a snapshot file")
+def snapshot(
+    output: str = typer.Option(..., help="Snapshot file to write (or resume)"),
+    env: str = typer.Option("", help="Environment (dev/expr/stg1/prod)"),
+    config_path: str = typer.Option("", help="Path to the config.json file"),
+    concurrency: int = typer.Option(
+        1, help="Number of API calls to have in flight at once"
+    ),
+    pool_size: int = typer.Option(
+        0, help="Keep-alive connections per host (defaults to --concurrency)"
+    ),
+    batch_size: int = typer.Option(
+        DEFAULT_BATCH_SIZE, help="Number of stored responses per db commit"
+    ),
+    rate_limit: float = typer.Option(
+        0.0, help="Maximum requests per second to the environment (0 for no limit)"
+    ),
+    burst: int = typer.Option(
+        0, help="Requests allowed in a burst above --rate-limit (defaults to it)"
+    ),
+    headless: bool = typer.Option(
+        False, help="Never prompt; needs credentials from env/files"
+    ),
+    totp_file: str = typer.Option(
+        "", help="File holding the TOTP (API3_TOTP also works)"
+    ),
+    token_file: str = typer.Option(
+        "", help="File holding a pre-issued API3 token (API3_TOKEN also works)"
+    ),
+    prometheus_textfile: str = typer.Option(
+        "", help="Also write the snapshot's metrics to this Prometheus textfile"
+    ),
+    shard: str = typer.Option(
+        "", help="Only snapshot shard i/N of the cid x call matrix, e.g. 2/4"
+    ),
+    local_shards: int = typer.Option(
+        0, help="Snapshot N shards in N local processes, then merge them"
+    ),
+):
+    validate_snapshot_inputs(
+        env,
+        config_path,
+        output,
+        concurrency,
+        pool_size,
+        batch_size,
+        rate_limit,
+        burst,
+        totp_file,
+        token_file,
+        shard,
+        local_shards,
+    )
+    if local_shards:
+        take_local_shards(
+            output,
+            local_shards,
+            env,
+            config_path,
+            concurrency,
+            pool_size,
+            batch_size,
+            rate_limit,
+            burst,
+            headless,
+            totp_file,
+            token_file,
+        )
+    else:
+        take_snapshot(
+            output,
+            env,
+            config_path,
+            concurrency,
+            pool_size,
+            batch_size,
+            rate_limit,
+            burst,
+            headless,
+            totp_file,
+            token_file,
+            prometheus_textfile,
+            shard,
+        )
+    close_sessions()
+
+
+@app.command(help="Diff two snapshots and summarize the changes")
+def compare(
+    before: str = typer.Argument(..., help="Snapshot to compare against"),
+    after: str = typer.Argument(..., help="Snapshot to compare"),
+    output_dir: str = typer.Option("", help="Output directory for the comparison"),
+    summary_type: str = typer.Option(
+        "endpoint", help="Summary type: 'all', 'endpoint', 'cid'"
+    ),
+    diff_workers: int = typer.Option(
+        0, help="Processes used to diff responses (0 uses every core)"
+    ),
+    prometheus_textfile: str = typer.Option(
+        "", help="Also write the comparison's metrics to this Prometheus textfile"
+    ),
+    diff_cache_size: int = typer.Option(
+        DEFAULT_CACHE_SIZE_MB,
+        help="Size in MB of the diff cache shared by all runs (0 turns it off)",
+    ),
+):
+    for snapshot_path in [before, after]:
+        if not os.path.isfile(snapshot_path):
+            raise FileNotFoundError(f"Snapshot '{snapshot_path}' does not exist.")
+    if summary_type not in ["all", "endpoint", "cid"]:
+        raise ValueError(
+            "Invalid summary type. Please choose 'all', 'endpoint', or 'cid'."
+        )
+    if diff_workers < 0:
+        raise ValueError("diff_workers must not be negative.")
+    if diff_cache_size < 0:
+        raise ValueError("diff_cache_size must not be negative.")
+    compare_snapshots(
+        before,
+        after,
+        output_dir,
+        summary_type,
+        diff_workers,
+        prometheus_textfile=prometheus_textfile,
+        diff_cache_size=diff_cache_size,
+    )
+
+
+@app.command(help="Re-diff and re-summarize a run offline, from its stored responses")
+def recompare(
+    run_dir: str = typer.Argument(..., help="Run directory to recompare"),
+    config_path: str = typer.Option(
+        "", help="Updated config; only calls whose diff options changed are re-diffed"
+    ),
+    summary_type: str = typer.Option(
+        "endpoint", help="Summary type: 'all', 'endpoint', 'cid'"
+    ),
+    threshold: float = typer.Option(
+        THRESHOLD, help="Percentage change above which a warning is raised"
+    ),
+    diff_workers: int = typer.Option(
+        0, help="Processes used to diff responses (0 uses every core)"
+    ),
+    diff_cache_size: int = typer.Option(
+        DEFAULT_CACHE_SIZE_MB,
+        help="Size in MB of the diff cache shared by all runs (0 turns it off)",
+    ),
+):
+    for name in ["config.json", "responses.db"]:
+        if not os.path.isfile(os.path.join(run_dir, name)):
+            raise FileNotFoundError(
+                f"'{run_dir}' has no {name}; is it a run directory?"
+            )
+    if config_path and not os.path.exists(config_path):
+        raise FileNotFoundError(f"Config file '{config_path}' does not exist.")
+    if summary_type not in ["all", "endpoint", "cid"]:
+        raise ValueError(
+            "Invalid summary type. Please choose 'all', 'endpoint', or 'cid'."
+        )
+    if threshold < 0:
+        raise ValueError("threshold must not be negative.")
+    if diff_workers < 0:
+        raise ValueError("diff_workers must not be negative.")
+    if diff_cache_size < 0:
+        raise ValueError("diff_cache_size must not be negative.")
+    recompare_run(
+        run_dir, config_path, summary_type, threshold, diff_workers, diff_cache_size
+    )
+
+
+@app.command(help="Query the changes table of a summarized run")
+def changes(
+    run_dir: str = typer.Argument(..., help="Run directory to query"),
+    top: int = typer.Option(20, help="Show the N largest changes"),
+    path: str = typer.Option(
+        "", help="Instead, list the customer ids changed at this path"
+    ),
+    threshold: float = typer.Option(
+        -1.0, help="Instead, list every change above this percentage"
+    ),
+    endpoint: str = typer.Option("", help="Only consider this endpoint (eid)"),
+):
+    db_path = os.path.join(run_dir, "responses.db")
+    if not os.path.isfile(db_path):
+        raise FileNotFoundError(f"'{run_dir}' has no responses.db.")
+    if top < 1:
+        raise ValueError("top must be at least 1.")
+    store = ResponseStore(db_path)
+    if path:
+        found = store.cids_at_path(path, endpoint or None)
+    elif threshold >= 0:
+        found = store.changes_above(threshold, endpoint=endpoint or None)
+    else:
+        found = store.top_changes(top, endpoint or None)
+    store.close()
+    typer.echo(json.dumps(found, indent=4))
+
+
+@app.command(help="Combine shard runs or snapshots into one")
+def merge(
+    inputs: List[str] = typer.Argument(
+        ..., help="Run directories from 'start --shard', or snapshot files"
+    ),
+    output: str = typer.Option("", help="Merged snapshot file (for snapshots)"),
+    output_dir: str = typer.Option("", help="Output directory for the merged run"),
+    summary_type: str = typer.Option(
+        "endpoint", help="Summary type: 'all', 'endpoint', 'cid'"
+    ),
+    diff_workers: int = typer.Option(
+        0, help="Processes used to diff responses (0 uses every core)"
+    ),
+    prometheus_textfile: str = typer.Option(
+        "", help="Also write the merge's metrics to this Prometheus textfile"
+    ),
+    diff_cache_size: int = typer.Option(
+        DEFAULT_CACHE_SIZE_MB,
+        help="Size in MB of the diff cache shared by all runs (0 turns it off)",
+    ),
+):
+    if all(os.path.isdir(path) for path in inputs):
+        for run_dir in inputs:
+            for run_file in ["config.json", "responses.db"]:
+                if not os.path.isfile(os.path.join(run_dir, run_file)):
+                    raise FileNotFoundError(
+                        f"Cannot merge: '{run_file}' does not exist in '{run_dir}'."
+                    )
+        if summary_type not in ["all", "endpoint", "cid"]:
+            raise ValueError(
+                "Invalid summary type. Please choose 'all', 'endpoint', or 'cid'."
+            )
+        if diff_workers < 0:
+            raise ValueError("diff_workers must not be negative.")
+        if diff_cache_size < 0:
+            raise ValueError("diff_cache_size must not be negative.")
+        merge_runs(
+            inputs,
+            output_dir,
+            summary_type,
+            diff_workers,
+            prometheus_textfile=prometheus_textfile,
+            diff_cache_size=diff_cache_size,
+        )
+    elif all(os.path.isfile(path) for path in inputs):
+        if not output:
+            raise ValueError("Merging snapshots needs --output.")
+        merge_snapshots(output, inputs)
+    else:
+        raise ValueError("Inputs must be all run directories or all snapshot files.")
+
+
+@app.command(help="Run a local daemon that takes snapshot and compare jobs")
+def serve(
+    host: str = typer.Option("127.0.0.1", help="Address to listen on"),
+    port: int = typer.Option(DEFAULT_PORT, help="Port to listen on"),
+    socket: str = typer.Option(
+        "", help="Listen on this Unix socket instead of a TCP port"
+    ),
+    job_workers: int = typer.Option(2, help="Jobs run at the same time"),
+    diff_workers: int = typer.Option(
+        0, help="Processes kept running to diff responses (0 uses every core)"
+    ),
+    pool_size: int = typer.Option(
+        DEFAULT_POOL_SIZE, help="Keep-alive connections per host"
+    ),
+    diff_cache_size: int = typer.Option(
+        DEFAULT_CACHE_SIZE_MB,
+        help="Size in MB of the diff cache shared by all runs (0 turns it off)",
+    ),
+    totp_file: str = typer.Option(
+        "", help="File holding the TOTP (API3_TOTP also works)"
+    ),
+    token_file: str = typer.Option(
+        "", help="File holding a pre-issued API3 token (API3_TOKEN also works)"
+    ),
+    env: List[str] = typer.Option(
+        [], help="Log in to this environment at startup (can be repeated)"
+    ),
+):
+    for name in env:
+        if name not in ["dev", "expr", "stg1", "prod"]:
+            raise ValueError(
+                "Invalid environment. Please choose one of 'dev', 'stg1', 'expr', or 'prod'."
+            )
+    if job_workers < 1:
+        raise ValueError("job_workers must be at least 1.")
+    if diff_workers < 0:
+        raise ValueError("diff_workers must not be negative.")
+    if pool_size < 1:
+        raise ValueError("pool_size must be at least 1.")
+    if diff_cache_size < 0:
+        raise ValueError("diff_cache_size must not be negative.")
+    for secret_file in [totp_file, token_file]:
+        if secret_file and not os.path.isfile(secret_file):
+            raise FileNotFoundError(f"Secret file '{secret_file}' does not exist.")
+    serve_jobs(
+        host,
+        port,
+        socket,
+        job_workers,
+        diff_workers,
+        pool_size,
+        diff_cache_size,
+        totp_file,
+        token_file,
+        env,
+    )
+
+
 if __name__ == "__main__":
-    typer.run(start)
+    app()
@@ -0,0 +1,335 @@
+import contextvars
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from auth import configure_headless, get_auth_token
+from db import DEFAULT_BATCH_SIZE
+from diff_cache import DEFAULT_CACHE_SIZE_MB
+from metrics import metrics, MetricsRegistry
+from output import c_print
+from sessions import configure_pool_size, close_sessions
+from shards import parse_shard
+from snapshot import take_snapshot, compare_snapshots
+from utils import resolve_diff_workers
+
+DEFAULT_PORT = 5324
+
+# Finished jobs are kept for GET /jobs/<id> until there are more than this
+MAX_FINISHED_JOBS = 1000
+
+ENVS = ["dev", "expr", "stg1", "prod"]
+SUMMARY_TYPES = ["all", "endpoint", "cid"]
+
+
+def snapshot_job(spec, job_id):
+    output = spec.get("output")
+    if not output:
+        raise ValueError("A snapshot job needs an output path.")
+    # An existing snapshot file is resumed with its own env and config
+    if not os.path.exists(output):
+        if spec.get("env") not in ENVS:
+            raise ValueError(f"env must be one of {ENVS}.")
+        if not os.path.isfile(spec.get("config_path") or ""):
+            raise FileNotFoundError(
+                f"Config file '{spec.get('config_path')}' does not exist."
+            )
+    if int(spec.get("concurrency", 1)) < 1:
+        raise ValueError("concurrency must be at least 1.")
+    if float(spec.get("rate_limit", 0)) < 0 or int(spec.get("burst", 0)) < 0:
+        raise ValueError("rate_limit and burst must not be negative.")
+    parse_shard(spec.get("shard", ""))
+
+    def run(daemon):
+        take_snapshot(
+            output,
+            spec.get("env", ""),
+            spec.get("config_path", ""),
+            int(spec.get("concurrency", 1)),
+            daemon.pool_size,
+            DEFAULT_BATCH_SIZE,
+            float(spec.get("rate_limit", 0)),
+            int(spec.get("burst", 0)),
+            True,
+            daemon.totp_file,
+            daemon.token_file,
+            shard=spec.get("shard", ""),
+        )
+        return {"snapshot": os.path.abspath(output)}
+
+    return output, run
+
+
+def compare_job(spec, job_id):
+    for key in ["before", "after"]:
+        if not os.path.isfile(spec.get(key) or ""):
+            raise FileNotFoundError(f"Snapshot '{spec.get(key)}' does not exist.")
+    summary_type = spec.get("summary_type", "endpoint")
+    if summary_type not in SUMMARY_TYPES:
+        raise ValueError(f"summary_type must be one of {SUMMARY_TYPES}.")
+    # Without an output_dir, a job writes to a run directory named after it,
+    # as jobs started in the same second would otherwise share one
+    output_dir = spec.get("output_dir") or os.path.join("runs", job_id)
+
+    def run(daemon):
+        run_dir = compare_snapshots(
+            spec["before"],
+            spec["after"],
+            output_dir,
+            summary_type,
+            diff_cache_size=daemon.diff_cache_size,
+            executor=daemon.executor,
+        )
+        return {"run_dir": run_dir}
+
+    return output_dir, run
+
+
+# Each job type checks a submitted spec, raising on a bad one, and returns
+# the path the job writes to and the function a job worker runs it with
+JOB_TYPES = {"snapshot": snapshot_job, "compare": compare_job}
+
+
+class Daemon:
+    # Runs snapshot and compare jobs in one long-lived process, so each job
+    # starts with warm connection pools, cached tokens and running diff
+    # workers. Jobs wait in a queue for one of job_workers threads. As the
+    # process always runs headless, it never prompts.
+    def __init__(
+        self,
+        job_workers=2,
+        diff_workers=0,
+        pool_size=10,
+        diff_cache_size=DEFAULT_CACHE_SIZE_MB,
+        totp_file="",
+        token_file="",
+    ):
+        self.pool_size = pool_size
+        self.diff_cache_size = diff_cache_size
+        self.totp_file = totp_file
+        self.token_file = token_file
+        self.started = time.time()
+        self.jobs = {}
+        # Paths written by queued and running jobs
+        self._outputs = set()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+
+        configure_headless(True, totp_file, token_file)
+        configure_pool_size(pool_size)
+
+        # Start the diff workers now, before any other threads exist
+        self.executor = ProcessPoolExecutor(
+            max_workers=resolve_diff_workers(diff_workers)
+        )
+        self.executor.submit(int).result()
+        self.threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(job_workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def warm(self, envs):
+        # Log in up front, so the first job does not pay for it
+        for env in envs:
+            get_auth_token(env)
+
+    def submit(self, spec):
+        job_type = spec.get("type")
+        if job_type not in JOB_TYPES:
+            raise ValueError(f"type must be one of {list(JOB_TYPES)}.")
+        job_id = uuid.uuid4().hex[:12]
+        output, run = JOB_TYPES[job_type](spec, job_id)
+        job = {
+            "id": job_id,
+            "type": job_type,
+            "spec": spec,
+            "status": "queued",
+            "submitted_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        output = os.path.realpath(output)
+        with self._lock:
+            if output in self._outputs:
+                raise ValueError(f"'{output}' is in use by another job.")
+            self._outputs.add(output)
+            self.jobs[job_id] = job
+            self._forget_finished()
+        self._queue.put((job, output, run))
+        metrics.process.counter("jobs_total", type=job_type).inc()
+        return dict(job)
+
+    def _forget_finished(self):
+        finished = [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job["status"] in ("done", "failed")
+        ]
+        for job_id in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            job, output, run = self._queue.get()
+            start = time.perf_counter()
+            self._update(
+                job,
+                status="running",
+                started_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            )
+            c_print.blue(f"Job {job['id']} ({job['type']}) started")
+            registry = MetricsRegistry()
+            try:
+                result = contextvars.Context().run(self._run, run, registry)
+                self._update(job, status="done", result=result)
+                c_print.ok(f"Job {job['id']} done")
+            except Exception as e:
+                self._update(job, status="failed", error=f"{type(e).__name__}: {e}")
+                c_print.fail(f"Job {job['id']} failed: {e}")
+                metrics.process.counter("failed_jobs_total", type=job["type"]).inc()
+            seconds = time.perf_counter() - start
+            self._update(job, seconds=seconds)
+            with self._lock:
+                self._outputs.discard(output)
+            metrics.process.merge(registry)
+            metrics.process.histogram("job_seconds", type=job["type"]).observe(seconds)
+
+    def _run(self, run, registry):
+        # Each job runs in a context of its own, with its own metrics (so its
+        # metrics.json covers only that job) and rate limits. The daemon's
+        # metrics add up every job's.
+        with metrics.scope(registry):
+            return run(self)
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self):
+        with self._lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def health(self):
+        with self._lock:
+            statuses = [job["status"] for job in self.jobs.values()]
+        return {
+            "status": "ok",
+            "uptime_seconds": time.time() - self.started,
+            **{
+                status: statuses.count(status)
+                for status in ["queued", "running", "done", "failed"]
+            },
+        }
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        close_sessions()
+
+
+def make_handler(daemon):
+    class JobHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, status, payload, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def send_json(self, status, body):
+            self.send_body(status, json.dumps(body).encode("utf-8"), "application/json")
+
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            if path == "/health":
+                return self.send_json(200, daemon.health())
+            if path == "/metrics":
+                return self.send_body(
+                    200, metrics.process.prometheus_text().encode("utf-8"), "text/plain"
+                )
+            if path == "/jobs":
+                return self.send_json(200, daemon.list())
+            if path.startswith("/jobs/"):
+                job = daemon.get(path.split("/")[2])
+                if job:
+                    return self.send_json(200, job)
+            self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path.rstrip("/") != "/jobs":
+                return self.send_json(404, {"error": "not found"})
+            try:
+                spec = json.loads(body)
+                if not isinstance(spec, dict):
+                    raise ValueError("A job must be a JSON object.")
+                job = daemon.submit(spec)
+            except (ValueError, TypeError, OSError) as e:
+                return self.send_json(400, {"error": str(e)})
+            self.send_json(202, job)
+
+    return JobHandler
+
+
+class JobServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class UnixJobServer(JobServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def serve(
+    host="127.0.0.1",
+    port=DEFAULT_PORT,
+    unix_socket="",
+    job_workers=2,
+    diff_workers=0,
+    pool_size=10,
+    diff_cache_size=DEFAULT_CACHE_SIZE_MB,
+    totp_file="",
+    token_file="",
+    envs=None,
+):
+    daemon = Daemon(
+        job_workers, diff_workers, pool_size, diff_cache_size, totp_file, token_file
+    )
+    daemon.warm(envs or [])
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixJobServer(unix_socket, make_handler(daemon))
+        c_print.ok(f"Serving jobs on {unix_socket}")
+    else:
+        server = JobServer((host, port), make_handler(daemon))
+        c_print.ok(f"Serving jobs on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
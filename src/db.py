@@ -1,11 +1,138 @@
 import sqlite3
+import hashlib
 import json
+import os
+import threading
+import time
+import zlib
+from collections import namedtuple
+from urllib.parse import quote
+from hashing import blob_hash, canonical_hash
+from metrics import metrics
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def create_database(db_path):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute(
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_BATCH_SIZE = 100
+
+# Streamed responses larger than this are stored without a canonical hash,
+# rather than held in memory to be parsed; they are always diffed
+CANONICAL_HASH_LIMIT = 64 * 1024 * 1024
+
+# Stored in place of a response when every attempt at the call failed
+FAILED_RESPONSE = {"error": "API call failed"}
+FAILED_RESPONSE_HASH = blob_hash(json.dumps(FAILED_RESPONSE).encode("utf-8"))
+
+# Columns returned by the changes queries, plus the group some callers ask for
+CHANGE_COLUMNS = [
+    "customer_id",
+    "endpoint",
+    "change_type",
+    "path",
+    "old_value",
+    "new_value",
+    "pct_change",
+    "value_type",
+    "group",
+]
+
+# A response ready to be written: the compressed payload, keyed by the hash of
+# its raw bytes, plus the canonical hash used to skip unchanged pairs
+EncodedResponse = namedtuple(
+    "EncodedResponse", ["blob_hash", "codec", "data", "size", "content_hash"]
+)
+
+
+def parse_json(data):
+    # orjson is much faster, but only handles integers that fit in 64 bits
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def compressor():
+    if zstandard:
+        return "zstd", zstandard.ZstdCompressor(level=3).compressobj()
+    return "zlib", zlib.compressobj(6)
+
+
+def compress(raw):
+    codec, stream = compressor()
+    return codec, stream.compress(raw) + stream.flush()
+
+
+def decompress(codec, data):
+    if codec == "zstd":
+        if not zstandard:
+            raise RuntimeError("zstandard must be installed to read this db")
+        # Streamed frames do not record their content size up front
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_response(response, exclude_paths=None):
+    if isinstance(response, str):
+        response = json.loads(response)
+
+    # Empty responses get no hash, so they are never treated as unchanged
+    content_hash = canonical_hash(response, exclude_paths) if response else None
+
+    raw = json.dumps(response).encode("utf-8")
+    codec, data = compress(raw)
+    return EncodedResponse(blob_hash(raw), codec, data, len(raw), content_hash)
+
+
+def encode_response_stream(chunks, exclude_paths=None):
+    # Hashes and compresses a response body as it is read, so the raw bytes
+    # go to storage without being parsed and dumped again. Raises ValueError
+    # for a body that is not JSON, and returns None for an empty one.
+    codec, stream = compressor()
+    hasher = hashlib.sha256()
+    compressed = []
+    buffered = []
+    size = 0
+    for chunk in chunks:
+        hasher.update(chunk)
+        compressed.append(stream.compress(chunk))
+        size += len(chunk)
+        if size <= CANONICAL_HASH_LIMIT:
+            buffered.append(chunk)
+        else:
+            buffered = None
+    compressed.append(stream.flush())
+
+    content_hash = None
+    if buffered is not None:
+        response = parse_json(b"".join(buffered))
+        if not response:
+            return None
+        content_hash = canonical_hash(response, exclude_paths)
+
+    return EncodedResponse(
+        hasher.hexdigest(), codec, b"".join(compressed), size, content_hash
+    )
+
+
+def add_missing_columns(conn, table, columns):
+    # Bring dbs from earlier versions of the tool up to the current schema
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, column_type in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+
+def create_schema(conn):
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS api_responses (
             id INTEGER PRIMARY KEY,
@@ -13,80 +140,419 @@ def create_database(db_path):
             endpoint TEXT NOT NULL,
             response_before TEXT,
             response_after TEXT,
-            difference TEXT
+            difference TEXT,
+            hash_before TEXT,
+            hash_after TEXT,
+            blob_before TEXT,
+            blob_after TEXT
+        )
+    """
+    )
+    add_missing_columns(
+        conn,
+        "api_responses",
+        {
+            "hash_before": "TEXT",
+            "hash_after": "TEXT",
+            "blob_before": "TEXT",
+            "blob_after": "TEXT",
+        },
+    )
+    # Response payloads, stored once per distinct content
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            codec TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )
+    """
+    )
+    # Other dbs (snapshots) whose blobs this one reads rather than copies;
+    # each is attached read-only under its name whenever the db is opened
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blob_sources (
+            name TEXT PRIMARY KEY,
+            path TEXT NOT NULL
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_api_responses_cid_endpoint
+        ON api_responses (customer_id, endpoint)
+    """
+    )
+    # Every diff flattened to one row per path of each DeepDiff report, with
+    # the report's name as change_type, so reports and queries do not walk
+    # results.json. A pair without values_changed also gets a "none" row.
+    # Values are JSON. pct_change is what the summaries average, NULL for
+    # changes they leave out, and value_type is "number" or "array" for the
+    # numeric values_changed rows. The table is rebuilt from results.jsonl on
+    # every summary, so a table from an earlier layout is just dropped.
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(changes)")}
+    if columns and "value_type" not in columns:
+        conn.execute("DROP TABLE changes")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS changes (
+            id INTEGER PRIMARY KEY,
+            customer_id TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            change_type TEXT NOT NULL,
+            path TEXT NOT NULL,
+            old_value TEXT,
+            new_value TEXT,
+            pct_change REAL,
+            value_type TEXT
         )
     """
     )
+    for column in ["customer_id", "endpoint", "path", "pct_change"]:
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_changes_{column} ON changes ({column})"
+        )
     conn.commit()
-    conn.close()
 
 
-def insert_or_update_response(db_path, customer_id, endpoint, response, before=True):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+def _response_text(legacy_text, codec, data):
+    # Raw JSON bytes for blobs, text for rows written by older versions
+    if data is not None:
+        return decompress(codec, data)
+    return legacy_text
 
-    # Serialize response to JSON if it's a dictionary
-    if isinstance(response, dict):
-        response = json.dumps(response)
 
-    # Check if the row exists
-    cursor.execute(
-        "SELECT id FROM api_responses WHERE customer_id = ? AND endpoint = ?",
-        (customer_id, endpoint),
-    )
-    row = cursor.fetchone()
-
-    if row is None:
-        # Insert a new row if it doesn't exist
-        if before:
-            cursor.execute(
-                "INSERT INTO api_responses (customer_id, endpoint, response_before) VALUES (?, ?, ?)",
-                (customer_id, endpoint, response),
+class ResponseStore:
+    # A single long-lived connection to responses.db. Writes are grouped into
+    # transactions of batch_size rows; call flush() at the end of each phase
+    # so everything written so far is committed.
+    def __init__(self, db_path, batch_size=DEFAULT_BATCH_SIZE):
+        self.db_path = db_path
+        self.batch_size = max(1, batch_size)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, uri=True)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+        self.conn.execute("PRAGMA cache_size = -65536")
+        create_schema(self.conn)
+        self._blob_schemas = ["main"]
+        self._missing_sources = []
+        for name, path in self.conn.execute("SELECT name, path FROM blob_sources"):
+            self._attach_source(name, path)
+
+    def _attach_source(self, name, path):
+        if not os.path.isfile(path):
+            self._missing_sources.append(path)
+            return
+        self.conn.execute(
+            f"ATTACH DATABASE ? AS {name}", (f"file:{quote(path)}?mode=ro",)
+        )
+        self._blob_schemas.append(name)
+
+    def _blob(self, blob_hash):
+        # (codec, data), looked up here first and then in each blob source
+        for schema in self._blob_schemas:
+            row = self.conn.execute(
+                f"SELECT codec, data FROM {schema}.blobs WHERE hash = ?", (blob_hash,)
+            ).fetchone()
+            if row:
+                return row
+        if self._missing_sources:
+            raise FileNotFoundError(
+                f"Responses are stored in {self._missing_sources}, which no longer exist."
             )
-        else:
-            cursor.execute(
-                "INSERT INTO api_responses (customer_id, endpoint, response_after) VALUES (?, ?, ?)",
-                (customer_id, endpoint, response),
+        return None, None
+
+    @property
+    def pending_writes(self):
+        return self._pending
+
+    def _commit(self):
+        with metrics.timer("store_commit_seconds"):
+            self.conn.commit()
+        self._pending = 0
+
+    def _wrote_row(self):
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self._commit()
+
+    def insert_or_update_response(
+        self, customer_id, endpoint, response, before=True, exclude_paths=None
+    ):
+        if not isinstance(response, EncodedResponse):
+            response = encode_response(response, exclude_paths)
+
+        column, blob_column, hash_column = (
+            ("response_before", "blob_before", "hash_before")
+            if before
+            else ("response_after", "blob_after", "hash_after")
+        )
+        start = time.perf_counter()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO blobs (hash, codec, size, data) VALUES (?, ?, ?, ?)",
+                (response.blob_hash, response.codec, response.size, response.data),
             )
-    else:
-        # Update the existing row
-        if before:
-            cursor.execute(
-                "UPDATE api_responses SET response_before = ? WHERE customer_id = ? AND endpoint = ?",
-                (response, customer_id, endpoint),
+            # The uncompressed column is only read for dbs from older versions
+            self.conn.execute(
+                f"""
+                INSERT INTO api_responses (customer_id, endpoint, {blob_column}, {hash_column})
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (customer_id, endpoint)
+                DO UPDATE SET {blob_column} = excluded.{blob_column},
+                    {hash_column} = excluded.{hash_column},
+                    {column} = NULL
+                """,
+                (customer_id, endpoint, response.blob_hash, response.content_hash),
             )
-        else:
-            cursor.execute(
-                "UPDATE api_responses SET response_after = ? WHERE customer_id = ? AND endpoint = ?",
-                (response, customer_id, endpoint),
+            self._wrote_row()
+        # Includes any batch commit this write triggered
+        metrics.histogram("store_write_seconds").observe(time.perf_counter() - start)
+
+    def get_responses(self, customer_id, endpoint):
+        with self._lock:
+            row = self.conn.execute(
+                """
+                SELECT response_before, blob_before, response_after, blob_after
+                FROM api_responses WHERE customer_id = ? AND endpoint = ?
+                """,
+                (customer_id, endpoint),
+            ).fetchone()
+            if not row:
+                return None, None
+            legacy_before, blob_before, legacy_after, blob_after = row
+            before = self._blob(blob_before) if blob_before else (None, None)
+            after = self._blob(blob_after) if blob_after else (None, None)
+        return _response_text(legacy_before, *before), _response_text(
+            legacy_after, *after
+        )
+
+    def get_hashes(self, customer_id, endpoint):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT hash_before, hash_after FROM api_responses WHERE customer_id = ? AND endpoint = ?",
+                (customer_id, endpoint),
+            ).fetchone()
+        return row if row else (None, None)
+
+    def get_blob_hashes(self, customer_id, endpoint):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT blob_before, blob_after FROM api_responses WHERE customer_id = ? AND endpoint = ?",
+                (customer_id, endpoint),
+            ).fetchone()
+        return row if row else (None, None)
+
+    def successful_responses(self, before=True):
+        column, blob_column = (
+            ("response_before", "blob_before")
+            if before
+            else ("response_after", "blob_after")
+        )
+        with self._lock:
+            rows = self.conn.execute(
+                f"""
+                SELECT customer_id, endpoint FROM api_responses
+                WHERE ({blob_column} IS NOT NULL AND {blob_column} != ?)
+                    OR ({column} IS NOT NULL AND {column} != ?)
+                """,
+                (FAILED_RESPONSE_HASH, json.dumps(FAILED_RESPONSE)),
+            ).fetchall()
+        return set(rows)
+
+    def has_responses(self, before=True):
+        column, blob_column = (
+            ("response_before", "blob_before")
+            if before
+            else ("response_after", "blob_after")
+        )
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT 1 FROM api_responses WHERE {blob_column} IS NOT NULL OR {column} IS NOT NULL LIMIT 1"
+            ).fetchone()
+        return row is not None
+
+    def _upsert_rows(self, schema, sides):
+        for source_side, side in sides.items():
+            self.conn.execute(
+                f"""
+                INSERT INTO api_responses (customer_id, endpoint, blob_{side}, hash_{side})
+                SELECT customer_id, endpoint, blob_{source_side}, hash_{source_side}
+                FROM {schema}.api_responses WHERE blob_{source_side} IS NOT NULL
+                ON CONFLICT (customer_id, endpoint)
+                DO UPDATE SET blob_{side} = excluded.blob_{side},
+                    hash_{side} = excluded.hash_{side}
+                """
             )
 
-    conn.commit()
-    conn.close()
+    def copy_responses(self, source_path, sides=None):
+        # Copies the responses stored in another db (a snapshot or a shard)
+        # into this one. sides maps each side to copy from the source to the
+        # side it lands on here; a snapshot keeps its responses on its
+        # "before" side. Blobs are copied as they are, and cells the source
+        # has no response for are left alone.
+        sides = sides or {"before": "before"}
+        with self._lock:
+            self._commit()
+            self.conn.execute("ATTACH DATABASE ? AS source", (source_path,))
+            try:
+                self.conn.execute(
+                    """
+                    INSERT OR IGNORE INTO blobs (hash, codec, size, data)
+                    SELECT hash, codec, size, data FROM source.blobs
+                    """
+                )
+                self._upsert_rows("source", sides)
+                self._commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                self.conn.execute("DETACH DATABASE source")
+
+    def link_responses(self, source_path, sides=None):
+        # Like copy_responses, but only the rows are copied: blobs are read
+        # from the source db in place, so it has to stay where it is. Cheap
+        # for comparing one large snapshot against many others.
+        sides = sides or {"before": "before"}
+        source_path = os.path.abspath(source_path)
+        with self._lock:
+            self._commit()
+            row = self.conn.execute(
+                "SELECT name FROM blob_sources WHERE path = ?", (source_path,)
+            ).fetchone()
+            if row:
+                name = row[0]
+            else:
+                (count,) = self.conn.execute(
+                    "SELECT COUNT(*) FROM blob_sources"
+                ).fetchone()
+                name = f"blob_source_{count}"
+                self._attach_source(name, source_path)
+                self.conn.execute(
+                    "INSERT INTO blob_sources (name, path) VALUES (?, ?)",
+                    (name, source_path),
+                )
+            try:
+                self._upsert_rows(name, sides)
+                self._commit()
+            except Exception:
+                self.conn.rollback()
+                raise
 
+    def set_hashes(self, customer_id, endpoint, hash_before, hash_after):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE api_responses SET hash_before = ?, hash_after = ? WHERE customer_id = ? AND endpoint = ?",
+                (hash_before, hash_after, customer_id, endpoint),
+            )
+            self._wrote_row()
 
-def get_responses(db_path, customer_id, endpoint):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    def clear_hashes(self, endpoints):
+        # Pairs without both hashes are always diffed
+        with self._lock:
+            self.conn.executemany(
+                "UPDATE api_responses SET hash_before = NULL, hash_after = NULL WHERE endpoint = ?",
+                [(endpoint,) for endpoint in endpoints],
+            )
+            self._commit()
 
-    cursor.execute(
-        "SELECT response_before, response_after FROM api_responses WHERE customer_id = ? AND endpoint = ?",
-        (customer_id, endpoint),
-    )
-    response_before, response_after = cursor.fetchone()
-    conn.close()
+    def set_difference(self, customer_id, endpoint, difference):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE api_responses SET difference = ? WHERE customer_id = ? AND endpoint = ?",
+                (difference, customer_id, endpoint),
+            )
+            self._wrote_row()
+
+    def replace_changes(self, rows):
+        # rows are (customer_id, endpoint, change_type, path, old_value,
+        # new_value, pct_change, value_type), in report order
+        with self._lock:
+            self._commit()
+            try:
+                self.conn.execute("DELETE FROM changes")
+                self.conn.executemany(
+                    """
+                    INSERT INTO changes (customer_id, endpoint, change_type, path,
+                        old_value, new_value, pct_change, value_type)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    rows,
+                )
+                self._commit()
+            except Exception:
+                self.conn.rollback()
+                raise
 
-    return response_before, response_after
+    def _query_changes(self, where, params, order, group_expr=None, limit=None):
+        group_column = f", {group_expr}" if group_expr else ""
+        query = f"""
+            SELECT customer_id, endpoint, change_type, path, old_value,
+                new_value, pct_change, value_type{group_column}
+            FROM changes WHERE {where} ORDER BY {order}
+        """
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        with self._lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [dict(zip(CHANGE_COLUMNS, row)) for row in rows]
 
+    def top_changes(self, n, endpoint=None):
+        # The n largest numeric changes, optionally for one endpoint
+        where, params = "value_type IS NOT NULL", []
+        if endpoint is not None:
+            where += " AND endpoint = ?"
+            params.append(endpoint)
+        return self._query_changes(where, params, "pct_change DESC, id", limit=n)
 
-def set_difference(db_path, customer_id, endpoint, difference):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    def cids_at_path(self, path, endpoint=None):
+        # Every customer id with a change at path, optionally for one endpoint
+        query = "SELECT DISTINCT customer_id FROM changes WHERE path = ?"
+        params = [path]
+        if endpoint is not None:
+            query += " AND endpoint = ?"
+            params.append(endpoint)
+        with self._lock:
+            rows = self.conn.execute(query + " ORDER BY customer_id", params)
+            return [row[0] for row in rows]
 
-    cursor.execute(
-        "UPDATE api_responses SET difference = ? WHERE customer_id = ? AND endpoint = ?",
-        (difference, customer_id, endpoint),
-    )
+    def changes_above(
+        self, threshold, value_types=None, group_expr=None, endpoint=None
+    ):
+        # Changes past threshold percent, in report order. group_expr (an SQL
+        # expression over the columns) adds each row's "group" for callers
+        # that roll changes up.
+        where, params = "pct_change > ?", [threshold]
+        if endpoint is not None:
+            where += " AND endpoint = ?"
+            params.append(endpoint)
+        if value_types:
+            where += f" AND value_type IN ({', '.join('?' for _ in value_types)})"
+            params.extend(value_types)
+        return self._query_changes(where, params, "id", group_expr)
 
-    conn.commit()
-    conn.close()
+    def change_averages(self, group_expr):
+        # (group, average pct_change) in order of each group's first change,
+        # over the changes the summaries average
+        with self._lock:
+            return self.conn.execute(
+                f"""
+                SELECT {group_expr} AS change_group, AVG(pct_change) FROM changes
+                WHERE pct_change IS NOT NULL
+                GROUP BY change_group ORDER BY MIN(id)
+                """
+            ).fetchall()
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
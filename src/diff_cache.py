@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import deepdiff
+from db import compress, decompress
+from output import c_print
+
+# Shared by every run on the machine, so repeated and overlapping comparisons
+# reuse each other's diffs. Entries are keyed by the raw content hashes of the
+# two payloads plus the options that shape the diff, so a cached diff is only
+# ever returned for exactly the same inputs.
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.cache/api3_comparator/diff_cache.db")
+DEFAULT_CACHE_SIZE_MB = 1024
+
+# Bump when the diff output changes, so older entries stop matching
+DIFF_CACHE_VERSION = 1
+
+_cache_path = os.getenv("API3_DIFF_CACHE") or DEFAULT_CACHE_PATH
+_cache_size_mb = DEFAULT_CACHE_SIZE_MB
+
+
+def configure_diff_cache(size_mb, path=""):
+    # A size of 0 turns the cache off
+    global _cache_path, _cache_size_mb
+    _cache_size_mb = size_mb
+    if path:
+        _cache_path = path
+
+
+def diff_cache_spec():
+    # What a diff worker needs to open the cache itself, or None if it is off
+    if not _cache_size_mb:
+        return None
+    return _cache_path, _cache_size_mb * 1024 * 1024
+
+
+def diff_options(call):
+    comparator = call.get("comparator") or "deepdiff"
+    options = {
+        "version": DIFF_CACHE_VERSION,
+        "comparator": comparator,
+        "exclude_paths": sorted(set(call.get("exclude_paths") or [])),
+    }
+    if comparator == "numeric":
+        align_key = call.get("align_key") or []
+        options["align_key"] = [align_key] if isinstance(align_key, str) else align_key
+        options["tolerance"] = float(call.get("tolerance") or 0.0)
+    else:
+        options["deepdiff"] = deepdiff.__version__
+    return options
+
+
+class DiffCache:
+    # An LRU of diffs in SQLite. Every process opens its own connection, and
+    # entries past max_bytes (of compressed diffs) are evicted least recently
+    # used first. Eviction runs once enough has been written since the last
+    # check, so puts stay cheap.
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self._unchecked = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS diff_cache (
+                key TEXT PRIMARY KEY,
+                codec TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_diff_cache_last_used ON diff_cache (last_used)"
+        )
+
+    @staticmethod
+    def key(blob_before, blob_after, call):
+        material = json.dumps([blob_before, blob_after, diff_options(call)])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        # A cache error is only ever a miss, never a failed diff
+        try:
+            row = self.conn.execute(
+                "SELECT codec, data FROM diff_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE diff_cache SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            diff = json.loads(decompress(*row))
+        except (sqlite3.Error, RuntimeError, ValueError) as e:
+            c_print.warn(f"Diff cache read failed: {e}")
+            return None
+        self.hits += 1
+        return diff
+
+    def put(self, key, diff):
+        codec, data = compress(json.dumps(diff).encode("utf-8"))
+        try:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO diff_cache (key, codec, size, data, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, codec, len(data), data, time.time()),
+            )
+            self._unchecked += len(data)
+            if self._unchecked >= self.max_bytes // 20:
+                self.evict()
+        except sqlite3.Error as e:
+            c_print.warn(f"Diff cache write failed: {e}")
+
+    def evict(self):
+        self._unchecked = 0
+        (total,) = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM diff_cache"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        # Make some headroom, so the next few puts do not evict again
+        excess = total - self.max_bytes * 0.9
+        stale = []
+        for key, size in self.conn.execute(
+            "SELECT key, size FROM diff_cache ORDER BY last_used"
+        ):
+            if excess <= 0:
+                break
+            stale.append((key,))
+            excess -= size
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany("DELETE FROM diff_cache WHERE key = ?", stale)
+        except sqlite3.Error:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def close(self):
+        self.conn.close()
+
+
+def open_diff_cache(spec):
+    # The cache only ever saves time, so a cache that cannot be opened (say,
+    # a read-only home directory) just means diffing without one
+    if spec is None:
+        return None
+    try:
+        return DiffCache(*spec)
+    except (OSError, sqlite3.Error) as e:
+        c_print.warn(f"Diff cache disabled: {e}")
+        return None
@@ -0,0 +1,47 @@
+import hashlib
+import json
+import re
+
+# An exclude path into a list, e.g. root['data'][0]. DeepDiff with
+# ignore_order=True matches list items up before it applies exclusions, so
+# the item it leaves out is not the one at that index in both payloads.
+INDEXED_PATH = re.compile(r"\[\d")
+
+
+def _canonical_json(value, path, exclude_paths):
+    # Paths are built the way DeepDiff reports them, e.g. root['data'][0],
+    # so exclude_paths from config.json apply here exactly as they do there
+    if isinstance(value, dict):
+        members = []
+        for key in sorted(value, key=str):
+            child_path = f"{path}[{key!r}]"
+            if child_path in exclude_paths:
+                continue
+            child = _canonical_json(value[key], child_path, exclude_paths)
+            members.append(f"{json.dumps(str(key))}:{child}")
+        return "{" + ",".join(members) + "}"
+    if isinstance(value, list):
+        # Sorting the serialized items makes arrays order-insensitive, to
+        # match DeepDiff(ignore_order=True)
+        items = [
+            _canonical_json(item, f"{path}[{index}]", exclude_paths)
+            for index, item in enumerate(value)
+        ]
+        return "[" + ",".join(sorted(items)) + "]"
+    return json.dumps(value)
+
+
+def canonical_hash(response, exclude_paths=None):
+    # Equal hashes mean DeepDiff would find no differences. The reverse does
+    # not hold (e.g. 1 vs 1.0), which only costs a diff we could have skipped.
+    # Returns None, so the pair is always diffed, where an exclude path has a
+    # list index: that cannot be made to match DeepDiff.
+    if any(INDEXED_PATH.search(path) for path in exclude_paths or []):
+        return None
+    canonical = _canonical_json(response, "root", set(exclude_paths or []))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def blob_hash(raw):
+    # Identifies stored payloads by their exact bytes
+    return hashlib.sha256(raw).hexdigest()
@@ -0,0 +1,72 @@
+import os
+import subprocess
+import time
+import requests
+from output import c_print
+
+POLL_INTERVAL = 5
+
+
+class PauseHook:
+    # Stands in for the Enter key between the "before" and "after" phases, for
+    # runs with nobody at the keyboard. Whichever hooks are configured run in
+    # order: a shell command (the change is done once it exits successfully),
+    # a trigger file (done once it is created or touched), then a health URL
+    # (done once it answers 2xx). A timeout of 0 waits forever.
+    def __init__(self, command="", trigger_file="", health_url="", timeout=0):
+        self.command = command
+        self.trigger_file = trigger_file
+        self.health_url = health_url
+        self.timeout = timeout
+
+    @property
+    def configured(self):
+        return bool(self.command or self.trigger_file or self.health_url)
+
+    def wait(self, test_run_dir):
+        started = time.time()
+        deadline = started + self.timeout if self.timeout else None
+        if self.command:
+            self.run_command(test_run_dir, deadline)
+        if self.trigger_file:
+            self.wait_for_trigger_file(started, deadline)
+        if self.health_url:
+            self.wait_for_health(deadline)
+
+    def run_command(self, test_run_dir, deadline):
+        c_print.blue(f"Running pause hook: {self.command}")
+        subprocess.run(
+            self.command,
+            shell=True,
+            check=True,
+            env={**os.environ, "API3_RUN_DIR": test_run_dir},
+            timeout=deadline - time.time() if deadline else None,
+        )
+
+    def wait_for_trigger_file(self, started, deadline):
+        # A trigger file left over from an earlier run has to be touched again
+        c_print.blue(f"Waiting for {self.trigger_file} to be created or touched...")
+        while True:
+            try:
+                if os.path.getmtime(self.trigger_file) >= started:
+                    return
+            except FileNotFoundError:
+                pass
+            self._sleep(deadline, f"trigger file {self.trigger_file}")
+
+    def wait_for_health(self, deadline):
+        c_print.blue(f"Waiting for {self.health_url} to report healthy...")
+        while True:
+            try:
+                response = requests.get(self.health_url, timeout=POLL_INTERVAL)
+                if response.status_code < 300:
+                    return
+                c_print.warn(f"Health check returned {response.status_code}")
+            except requests.exceptions.RequestException as e:
+                c_print.warn(f"Health check failed: {e}")
+            self._sleep(deadline, f"health check {self.health_url}")
+
+    def _sleep(self, deadline, waiting_for):
+        if deadline and time.time() + POLL_INTERVAL > deadline:
+            raise TimeoutError(f"Timed out waiting for {waiting_for}")
+        time.sleep(POLL_INTERVAL)
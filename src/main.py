@@ -1,15 +1,85 @@
 import json
+import requests
+import time
+from concurrent.futures import as_completed
 from api_client import make_api_call
+from pagination import fetch_all_pages
+from auth import get_auth_token, configure_headless
+from hooks import PauseHook
+from shards import parse_shard, in_shard, outside_shard
+from diff_cache import configure_diff_cache, DEFAULT_CACHE_SIZE_MB
 from user_input_client import generate_config_json
 from utils import (
     create_run_directory,
     load_json_file,
     compare_responses,
+    DiffPipeline,
+    materialize_results,
+    read_results,
     report_run_duration,
+    thread_pool,
 )
 from output import c_print
-from db import create_database, insert_or_update_response
-from synthesize_results import process_deepdiff_output
+from metrics import metrics, BYTES_BUCKETS
+from sessions import configure_pool_size, close_sessions
+from rate_limit import configure_rate_limit
+from db import (
+    ResponseStore,
+    DEFAULT_BATCH_SIZE,
+    FAILED_RESPONSE,
+    encode_response,
+    encode_response_stream,
+)
+from synthesize_results import change_rows, summarize_change_table, THRESHOLD
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def fetch_response(
+    cid, call, base_url, env, request_number, total_calls, page_executor=None
+):
+    with metrics.timer("fetch_seconds"):
+        encoded = fetch_encoded_response(
+            cid, call, base_url, env, request_number, total_calls, page_executor
+        )
+    metrics.histogram("response_bytes", BYTES_BUCKETS).observe(encoded.size)
+    return encoded
+
+
+def fetch_encoded_response(
+    cid, call, base_url, env, request_number, total_calls, page_executor=None
+):
+    # Construct the full API endpoint URL
+    url = f"/v3/accounts/{cid}/{call['url'].lstrip('/')}"  # Ensure no double slashes
+    c_print.time(f"Making request {request_number} of {total_calls} API: {url}")
+
+    if call.get("pagination"):
+        # Pages have to be parsed to be stitched together
+        response_data = fetch_all_pages(url, call, base_url, env, page_executor)
+        return encode_response(
+            response_data if response_data else FAILED_RESPONSE,
+            call.get("exclude_paths"),
+        )
+
+    def consume(response):
+        # The body is hashed and compressed as it is read, here on the worker
+        # thread, and never parsed into Python objects on its way to the db
+        try:
+            return encode_response_stream(
+                response.iter_content(STREAM_CHUNK_SIZE), call.get("exclude_paths")
+            )
+        except ValueError as e:
+            raise requests.exceptions.InvalidJSONError(f"Invalid JSON response: {e}")
+
+    encoded = make_api_call(
+        url,
+        call["method"],
+        body=call.get("body"),
+        base_url=base_url,
+        env=env,
+        consume=consume,
+    )
+    return encoded or encode_response(FAILED_RESPONSE)
 
 
 def execute_api_calls(
@@ -18,51 +88,112 @@ def execute_api_calls(
     base_url,
     run_order,
     env="prod",
-    db_path="db/responses.db",
+    store=None,
+    concurrency=1,
+    on_stored=None,
+    skip=None,
+    shard=None,
 ):
 
     total_calls = len(cids) * len(calls)
+    skip = skip or set()
+    if skip:
+        c_print.cyan(f"Skipping {len(skip)} responses already stored for {run_order}")
 
-    for cid in cids:
-        cid_index = cids.index(cid)
-        for call in calls:
-            # Construct the full API endpoint URL
-            url = f"/v3/accounts/{cid}/{call['url'].lstrip('/')}"  # Ensure no double slashes
-            call_index = calls.index(call)
-            c_print.time(
-                f"Making request {(cid_index * len(calls)) + (call_index + 1)} of {total_calls} API: {url}"
-            )
+    # Make sure we have a token before the workers start, so that a password
+    # prompt is only ever shown once
+    get_auth_token(env)
 
-            response_data = make_api_call(
-                url,
-                call["method"],
-                body=call.get("body"),
-                base_url=base_url,
-                env=env,
-            )
+    # Requests run on a bounded pool of worker threads. Responses are written
+    # to the db from this thread as they complete, so sqlite only ever sees a
+    # single writer. Extra pages of paginated calls get a pool of their own,
+    # so a call waiting on its pages never starves the pool it runs on.
+    page_executor = thread_pool(concurrency)
+    with thread_pool(concurrency) as executor:
+        futures = {}
+        for cid_index, cid in enumerate(cids):
+            for call_index, call in enumerate(calls):
+                if (cid, call["eid"]) in skip or not in_shard(cid, call["eid"], shard):
+                    continue
+                request_number = (cid_index * len(calls)) + (call_index + 1)
+                future = executor.submit(
+                    fetch_response,
+                    cid,
+                    call,
+                    base_url,
+                    env,
+                    request_number,
+                    total_calls,
+                    page_executor,
+                )
+                futures[future] = (cid, call)
 
-            eid = call["eid"]
+        for future in as_completed(futures):
+            cid, call = futures[future]
 
             # Save response data
-            if response_data:
-                insert_or_update_response(
-                    db_path, cid, eid, response_data, run_order == "before"
-                )
-            else:
-                insert_or_update_response(
-                    db_path,
-                    cid,
-                    eid,
-                    {"error": "API call failed"},
-                    run_order == "before",
-                )
+            store.insert_or_update_response(
+                cid,
+                call["eid"],
+                future.result(),
+                run_order == "before",
+                call.get("exclude_paths"),
+            )
+            if on_stored:
+                on_stored(cid, call)
+    page_executor.shutdown()
+
+    # Commit whatever is left of the last batch before moving on
+    store.flush()
 
     c_print.ok(f"API calls for {run_order} completed.")
     print("")
 
 
-def run_test_tool(env="", config_path="", output_dir="", summary_type="eid", skip_pause=False):
+def run_test_tool(
+    env="",
+    config_path="",
+    output_dir="",
+    summary_type="eid",
+    skip_pause=False,
+    concurrency=1,
+    pool_size=0,
+    batch_size=DEFAULT_BATCH_SIZE,
+    diff_workers=0,
+    pipeline_compare=False,
+    resume="",
+    rate_limit=0.0,
+    burst=0,
+    prometheus_textfile="",
+    headless=False,
+    totp_file="",
+    token_file="",
+    pause_hook="",
+    pause_trigger_file="",
+    pause_health_url="",
+    pause_timeout=0,
+    shard="",
+    diff_cache_size=DEFAULT_CACHE_SIZE_MB,
+):
+    run_start = time.perf_counter()
+    metrics.reset()
+    configure_headless(headless, totp_file, token_file)
+    configure_diff_cache(diff_cache_size)
+    pause = PauseHook(pause_hook, pause_trigger_file, pause_health_url, pause_timeout)
+
+    # Size the connection pools so every worker can hold a kept-alive connection
+    configure_pool_size(pool_size or concurrency)
+
+    if resume:
+        # Pick up an existing run where it left off
+        test_run_dir = resume
+        config_file = load_json_file(f"{test_run_dir}/config.json")
+        env = config_file.get("env") or env
+        c_print.blue(f"Resuming test run at {test_run_dir}")
+
     # Get environment and create test run directory
+    if not env and headless:
+        raise ValueError("Headless runs need --env or --resume.")
     if not env:
         env = input("Enter environment (dev/expr/stg1/prod): ").lower()
         valid_env_options = ["dev", "expr", "stg1", "prod"]
@@ -71,47 +202,137 @@ def run_test_tool(env="", config_path="", output_dir="", summary_type="eid", ski
                 "Invalid environment. Please enter a valid environment (dev/expr/stg1/prod)"
             ).lower()
 
-    test_run_dir = create_run_directory(env, output_dir)
-    c_print.blue(f"Test run will output at {test_run_dir}")
+    if not resume:
+        test_run_dir = create_run_directory(env, output_dir)
+        c_print.blue(f"Test run will output at {test_run_dir}")
+
+    if rate_limit:
+        configure_rate_limit(env, rate_limit, burst)
 
     # Create DB
     db_path = f"{test_run_dir}/responses.db"
-    create_database(db_path)
+    store = ResponseStore(db_path, batch_size)
 
-    # Generate config.json via CLI prompts
-    generate_config_json(test_run_dir, env, config_path)
-    input("Config file validated. Press Enter to execute API calls...")
-    print("")
+    if not resume:
+        # Generate config.json via CLI prompts
+        generate_config_json(test_run_dir, env, config_path)
+        if not headless:
+            input("Config file validated. Press Enter to execute API calls...")
+            print("")
 
     config_file = load_json_file(f"{test_run_dir}/config.json")
+    if shard and not resume:
+        # Recorded so a resumed or merged shard knows which cells are its own
+        config_file["shard"] = shard
+        with open(f"{test_run_dir}/config.json", "w", encoding="utf-8") as f:
+            json.dump(config_file, f, ensure_ascii=False, indent=4)
+    shard = parse_shard(config_file.get("shard"))
     base_url = config_file["base_url"]
     cids = config_file["cids"]
     calls = config_file["calls"]
 
+    # Cells that already hold a successful response are not requested again,
+    # and pairs already compared from those responses are not diffed again
+    stored_before = store.successful_responses(before=True) if resume else set()
+    stored_after = store.successful_responses(before=False) if resume else set()
+    after_started = store.has_responses(before=False) if resume else False
+    compared = set(read_results(test_run_dir)) if resume else set()
+    compared &= stored_before & stored_after
+    if shard:
+        index, count = shard
+        c_print.blue(f"Running shard {index} of {count}")
+        # Pairs in other shards are never compared here either
+        compared |= outside_shard(cids, calls, shard)
+
     # Execute API calls for "before"
     c_print.blue("Executing 'before' API calls...")
-    execute_api_calls(cids, calls, base_url, "before", env, db_path)
-
-    # Pause for database migration
-    if not skip_pause:
-        input(
-            "Please complete the change to be validated now. Press Enter to continue once done..."
+    with metrics.timer("phase_seconds", phase="before"):
+        execute_api_calls(
+            cids,
+            calls,
+            base_url,
+            "before",
+            env,
+            store,
+            concurrency,
+            skip=stored_before,
+            shard=shard,
         )
-        print("")
 
-    # Execute API calls for "after"
-    c_print.blue("Executing 'after' API calls...")
-    execute_api_calls(cids, calls, base_url, "after", env, db_path)
+    # Pause for database migration, unless the "after" phase already began.
+    # Headless runs only pause for a configured hook.
+    if not skip_pause and not after_started:
+        if pause.configured:
+            pause.wait(test_run_dir)
+        elif not headless:
+            input(
+                "Please complete the change to be validated now. Press Enter to continue once done..."
+            )
+            print("")
 
-    # Compare the results
-    c_print.blue("Comparing 'before' and 'after' API calls...")
-    compare_responses(test_run_dir, db_path, cids, calls)
+    if pipeline_compare:
+        # Execute API calls for "after", diffing each response as it lands
+        c_print.blue("Executing and comparing 'after' API calls...")
+        pipeline = DiffPipeline(store, diff_workers)
+        with metrics.timer("phase_seconds", phase="after"):
+            execute_api_calls(
+                cids,
+                calls,
+                base_url,
+                "after",
+                env,
+                store,
+                concurrency,
+                pipeline.submit,
+                skip=stored_after,
+                shard=shard,
+            )
+        # Only the diffs still outstanding once the phase is over
+        with metrics.timer("phase_seconds", phase="compare"):
+            pipeline.finish(test_run_dir, cids, calls, skip=compared)
+    else:
+        # Execute API calls for "after"
+        c_print.blue("Executing 'after' API calls...")
+        with metrics.timer("phase_seconds", phase="after"):
+            execute_api_calls(
+                cids,
+                calls,
+                base_url,
+                "after",
+                env,
+                store,
+                concurrency,
+                skip=stored_after,
+                shard=shard,
+            )
 
+        # Compare the results
+        c_print.blue("Comparing 'before' and 'after' API calls...")
+        with metrics.timer("phase_seconds", phase="compare"):
+            compare_responses(
+                test_run_dir, store, cids, calls, diff_workers, skip=compared
+            )
+    store.close()
+    # Every request has been made by now
+    close_sessions()
+
+    summarize_run(test_run_dir, summary_type)
+    write_run_metrics(test_run_dir, run_start, prometheus_textfile)
+
+    # Report duration and record end time to config.json
+    report_run_duration(test_run_dir)
+
+
+def summarize_run(test_run_dir, summary_type, threshold=THRESHOLD):
     # Process the output to summarized results
-    deepdiff_results = load_json_file(f"{test_run_dir}/results.json")
-    results_summary, threshold_warnings = process_deepdiff_output(
-        deepdiff_results, summary_type
-    )
+    with metrics.timer("phase_seconds", phase="summarize"):
+        deepdiff_results = materialize_results(test_run_dir)
+        store = ResponseStore(f"{test_run_dir}/responses.db")
+        store.replace_changes(change_rows(deepdiff_results))
+        results_summary, threshold_warnings = summarize_change_table(
+            store, summary_type, threshold
+        )
+        store.close()
     report_file = f"{test_run_dir}/report.json"
     with open(report_file, "w") as f:
         json.dump(results_summary, f, indent=4)
@@ -122,8 +343,14 @@ def run_test_tool(env="", config_path="", output_dir="", summary_type="eid", ski
         json.dump(threshold_warnings, f, indent=4)
     c_print.blue(f"Warnings written to {warnings_file}")
 
-    # Report duration and record end time to config.json
-    report_run_duration(test_run_dir)
+
+def write_run_metrics(test_run_dir, run_start, prometheus_textfile=""):
+    metrics.gauge("run_seconds").set(time.perf_counter() - run_start)
+    metrics_file = f"{test_run_dir}/metrics.json"
+    metrics.write_json(metrics_file)
+    c_print.blue(f"Metrics written to {metrics_file}")
+    if prometheus_textfile:
+        metrics.write_prometheus(prometheus_textfile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+import json
+import os
+import time
+from datetime import datetime
+from db import ResponseStore, DEFAULT_BATCH_SIZE
+from diff_cache import configure_diff_cache, DEFAULT_CACHE_SIZE_MB
+from main import summarize_run, write_run_metrics
+from metrics import metrics
+from output import c_print
+from shards import check_shard_coverage
+from utils import (
+    ResultsWriter,
+    compare_responses,
+    create_run_directory,
+    load_json_file,
+    read_results,
+    report_run_duration,
+)
+
+
+def merge_runs(
+    run_dirs,
+    output_dir="",
+    summary_type="endpoint",
+    diff_workers=0,
+    batch_size=DEFAULT_BATCH_SIZE,
+    prometheus_textfile="",
+    diff_cache_size=DEFAULT_CACHE_SIZE_MB,
+):
+    # Combines the run directories of `start --shard i/N` into one run. The
+    # shards' results are carried over, so only pairs no shard compared (say,
+    # one that died before comparing) are diffed here.
+    run_start = time.perf_counter()
+    metrics.reset()
+    configure_diff_cache(diff_cache_size)
+
+    configs = [load_json_file(f"{run_dir}/config.json") for run_dir in run_dirs]
+    config = dict(configs[0])
+    for run_dir, shard_config in zip(run_dirs, configs):
+        if (
+            shard_config["env"] != config["env"]
+            or shard_config["cids"] != config["cids"]
+            or shard_config["calls"] != config["calls"]
+        ):
+            raise ValueError(f"'{run_dir}' was run with a different config.")
+    check_shard_coverage([shard_config.get("shard") for shard_config in configs])
+
+    config.pop("shard", None)
+    config.pop("run_end", None)
+    config["run_start"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    config["merged_from"] = [os.path.abspath(run_dir) for run_dir in run_dirs]
+
+    test_run_dir = create_run_directory(config["env"], output_dir)
+    c_print.blue(f"Merged run will output at {test_run_dir}")
+    with open(f"{test_run_dir}/config.json", "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+
+    store = ResponseStore(f"{test_run_dir}/responses.db", batch_size)
+    results_writer = ResultsWriter(test_run_dir)
+    for run_dir in run_dirs:
+        store.copy_responses(
+            f"{run_dir}/responses.db", {"before": "before", "after": "after"}
+        )
+        for (cid, eid), result in read_results(run_dir).items():
+            results_writer.write(cid, eid, result)
+    results_writer.close()
+
+    compared = set(read_results(test_run_dir))
+    compared &= store.successful_responses(before=True)
+    compared &= store.successful_responses(before=False)
+
+    c_print.blue("Comparing pairs not compared by any shard...")
+    with metrics.timer("phase_seconds", phase="compare"):
+        compare_responses(
+            test_run_dir,
+            store,
+            config["cids"],
+            config["calls"],
+            diff_workers,
+            skip=compared,
+        )
+    store.close()
+
+    summarize_run(test_run_dir, summary_type)
+    write_run_metrics(test_run_dir, run_start, prometheus_textfile)
+    report_run_duration(test_run_dir)
+    return test_run_dir
@@ -0,0 +1,254 @@
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PROMETHEUS_PREFIX = "api3_comparator"
+
+# Log-spaced bucket layouts, as (first upper bound, growth factor, count).
+# Values above the last bound land in an overflow bucket.
+SECONDS_BUCKETS = (0.0005, 2, 20)
+BYTES_BUCKETS = (256, 4, 14)
+COUNT_BUCKETS = (1, 4, 12)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def merge(self, other):
+        self.inc(other.value)
+
+    def snapshot(self):
+        return {"type": "counter", "value": self.value}
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def merge(self, other):
+        self.set(other.value)
+
+    def snapshot(self):
+        return {"type": "gauge", "value": self.value}
+
+
+class Histogram:
+    # Counts observations into log-spaced buckets, so recording a sample is a
+    # single log() and an increment however many samples a run produces.
+    # Quantiles are estimated by interpolating within a bucket.
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        start, factor, count = buckets
+        self.buckets = buckets
+        self.bounds = [start * factor**index for index in range(count)]
+        self._start = start
+        self._log_factor = math.log(factor)
+        self.counts = [0] * (count + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def _bucket(self, value):
+        if value <= self._start:
+            return 0
+        index = math.ceil(math.log(value / self._start) / self._log_factor)
+        # Float error can put a value on a boundary one bucket too high
+        if index > 0 and value <= self.bounds[min(index, len(self.bounds)) - 1]:
+            index -= 1
+        return min(index, len(self.bounds))
+
+    def observe(self, value):
+        bucket = self._bucket(value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        # Both use the same buckets, as they are the same metric
+        with self._lock:
+            self.counts = [
+                mine + theirs for mine, theirs in zip(self.counts, other.counts)
+            ]
+            self.count += other.count
+            self.sum += other.sum
+            for bound, pick in [("min", min), ("max", max)]:
+                values = [
+                    v
+                    for v in (getattr(self, bound), getattr(other, bound))
+                    if v is not None
+                ]
+                setattr(self, bound, pick(values) if values else None)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                estimate = lower + (upper - lower) * (rank - seen) / count
+                return min(max(estimate, self.min), self.max)
+            seen += count
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.bounds + ["+Inf"], self.counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            return {
+                "type": "histogram",
+                "count": self.count,
+                "sum": self.sum,
+                "min": self.min,
+                "max": self.max,
+                "mean": self.sum / self.count if self.count else None,
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                "buckets": buckets,
+            }
+
+
+def metric_key(name, labels):
+    if not labels:
+        return name
+    label_text = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{label_text}}}"
+
+
+class MetricsRegistry:
+    # Process-wide named metrics, keyed by name and labels in Prometheus
+    # notation, e.g. requests{status="200"}. Metrics are created on first use.
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, labels, *args):
+        key = metric_key(name, labels)
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, kind(*args))
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, buckets=SECONDS_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, buckets)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name, **labels).observe(time.perf_counter() - start)
+
+    def merge(self, other):
+        # Adds another registry's metrics into this one
+        with other._lock:
+            theirs = dict(other._metrics)
+        for key, metric in theirs.items():
+            args = (metric.buckets,) if isinstance(metric, Histogram) else ()
+            with self._lock:
+                mine = self._metrics.setdefault(key, type(metric)(*args))
+            mine.merge(metric)
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+
+    def snapshot(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {key: metrics[key].snapshot() for key in sorted(metrics)}
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=4)
+
+    def prometheus_text(self):
+        # The Prometheus text exposition format
+        lines = []
+        typed = set()
+        for key, snapshot in self.snapshot().items():
+            name, _, label_text = key.partition("{")
+            name = f"{PROMETHEUS_PREFIX}_{name}"
+            label_text = label_text.rstrip("}")
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {snapshot['type']}")
+            if snapshot["type"] == "histogram":
+                for bound, count in snapshot["buckets"].items():
+                    labels = ",".join(filter(None, [label_text, f'le="{bound}"']))
+                    lines.append(f"{name}_bucket{{{labels}}} {count}")
+                labels = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{name}_sum{labels} {snapshot['sum']}")
+                lines.append(f"{name}_count{labels} {snapshot['count']}")
+            else:
+                labels = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{name}{labels} {snapshot['value']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # Textfile collector format. Written to a temp file and renamed into
+        # place, so the collector never reads a partial file.
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+
+_scoped_registry = contextvars.ContextVar("scoped_registry", default=None)
+
+
+class ScopedMetrics:
+    # What everything records into. Normally the process-wide registry, but
+    # a process running several runs at once (serve) gives each its own with
+    # scope(). Threads a run starts only see its scope if they adopt the
+    # run's context (utils.adopt_context).
+    def __init__(self):
+        self.process = MetricsRegistry()
+
+    def active(self):
+        return _scoped_registry.get() or self.process
+
+    @contextmanager
+    def scope(self, registry):
+        token = _scoped_registry.set(registry)
+        try:
+            yield registry
+        finally:
+            _scoped_registry.reset(token)
+
+    def __getattr__(self, name):
+        return getattr(self.active(), name)
+
+
+metrics = ScopedMetrics()
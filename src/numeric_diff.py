@@ -0,0 +1,134 @@
+import json
+from deepdiff import DeepDiff
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class NumericDiff:
+    # A structural diff for report payloads, selected per call with
+    # "comparator": "numeric" in config.json. Arrays of records are matched up
+    # by "align_key" (e.g. "id" or "date", or a list of candidates) instead of
+    # by hashing every subtree, and numbers are compared directly, ignoring
+    # changes within the relative "tolerance". The output uses DeepDiff's
+    # report names and path format, as plain JSON types.
+    def __init__(self, align_key=None, tolerance=0.0, exclude_paths=None):
+        if isinstance(align_key, str):
+            align_key = [align_key]
+        self.align_keys = align_key or []
+        self.tolerance = tolerance or 0.0
+        self.exclude_paths = set(exclude_paths or [])
+        self.changes = {}
+
+    def _report(self, report_type, path, value=None):
+        if report_type in ("dictionary_item_added", "dictionary_item_removed"):
+            self.changes.setdefault(report_type, []).append(path)
+        else:
+            self.changes.setdefault(report_type, {})[path] = value
+
+    def compare(self, old, new, path="root"):
+        if path in self.exclude_paths:
+            return
+        if is_number(old) and is_number(new):
+            self._compare_numbers(old, new, path)
+        elif type(old) is not type(new):
+            self._report(
+                "type_changes",
+                path,
+                {
+                    "old_type": type(old).__name__,
+                    "new_type": type(new).__name__,
+                    "old_value": old,
+                    "new_value": new,
+                },
+            )
+        elif isinstance(old, dict):
+            self._compare_dicts(old, new, path)
+        elif isinstance(old, list):
+            self._compare_lists(old, new, path)
+        elif old != new:
+            self._report("values_changed", path, {"old_value": old, "new_value": new})
+
+    def _compare_numbers(self, old, new, path):
+        delta = abs(new - old)
+        if delta == 0 or delta <= self.tolerance * max(abs(old), abs(new)):
+            return
+        self._report("values_changed", path, {"old_value": old, "new_value": new})
+
+    def _compare_dicts(self, old, new, path):
+        for key, old_value in old.items():
+            child_path = f"{path}[{key!r}]"
+            if key not in new:
+                if child_path not in self.exclude_paths:
+                    self._report("dictionary_item_removed", child_path)
+            else:
+                self.compare(old_value, new[key], child_path)
+        for key in new:
+            child_path = f"{path}[{key!r}]"
+            if key not in old and child_path not in self.exclude_paths:
+                self._report("dictionary_item_added", child_path)
+
+    def _align_key(self, items):
+        for key in self.align_keys:
+            if all(isinstance(item, dict) and key in item for item in items):
+                return key
+        return None
+
+    def _compare_lists(self, old, new, path):
+        key = self._align_key(old + new) if (old or new) else None
+        if key is not None:
+            self._compare_aligned(old, new, path, key)
+        elif all(not isinstance(item, (dict, list)) for item in old + new):
+            self._compare_scalar_lists(old, new, path)
+        else:
+            # Records without a usable key still need DeepDiff to pair them up
+            self._merge_deepdiff(old, new, path)
+
+    def _compare_aligned(self, old, new, path, key):
+        new_index = {}
+        for index, item in enumerate(new):
+            new_index.setdefault(json.dumps(item[key], sort_keys=True), index)
+        matched = set()
+        for index, item in enumerate(old):
+            match = new_index.get(json.dumps(item[key], sort_keys=True))
+            if match is None or match in matched:
+                self._report("iterable_item_removed", f"{path}[{index}]", item)
+            else:
+                matched.add(match)
+                self.compare(item, new[match], f"{path}[{index}]")
+        for index, item in enumerate(new):
+            if index not in matched:
+                self._report("iterable_item_added", f"{path}[{index}]", item)
+
+    def _compare_scalar_lists(self, old, new, path):
+        # Order and repetition are ignored, as with DeepDiff(ignore_order=True)
+        old_values = {json.dumps(item) for item in old}
+        new_values = {json.dumps(item) for item in new}
+        for index, item in enumerate(old):
+            if json.dumps(item) not in new_values:
+                self._report("iterable_item_removed", f"{path}[{index}]", item)
+        for index, item in enumerate(new):
+            if json.dumps(item) not in old_values:
+                self._report("iterable_item_added", f"{path}[{index}]", item)
+
+    def _merge_deepdiff(self, old, new, path):
+        exclude_paths = [
+            "root" + excluded[len(path) :]
+            for excluded in self.exclude_paths
+            if excluded.startswith(path)
+        ]
+        diff = DeepDiff(old, new, ignore_order=True, exclude_paths=exclude_paths)
+        for report_type, report in json.loads(diff.to_json()).items():
+            if isinstance(report, list):
+                for child_path in report:
+                    self._report(report_type, path + child_path[len("root") :])
+            else:
+                for child_path, value in report.items():
+                    self._report(report_type, path + child_path[len("root") :], value)
+
+
+def numeric_diff(old, new, align_key=None, tolerance=0.0, exclude_paths=None):
+    differ = NumericDiff(align_key, tolerance, exclude_paths)
+    differ.compare(old, new)
+    return differ.changes
@@ -0,0 +1,124 @@
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from api_client import make_api_call
+from output import c_print
+
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_MAX_PAGES = 100
+
+
+def with_params(url, params):
+    parts = urlsplit(url)
+    query = [
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in params
+    ]
+    query.extend((key, str(value)) for key, value in params.items())
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def get_path(data, path):
+    # Dotted paths into a page, e.g. "data" or "meta.next_cursor"
+    for key in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def set_path(data, path, value):
+    *parents, last = path.split(".")
+    for key in parents:
+        data = data.setdefault(key, {})
+    data[last] = value
+
+
+def fetch_all_pages(url, call, base_url, env, page_executor):
+    # Fetches every page of a paginated call and returns them as one logical
+    # response: the first page, with the items of all pages under items_path.
+    # Returns None if any page fails, so the cell is stored as failed.
+    spec = call["pagination"]
+    items_path = spec.get("items_path", "data")
+    max_pages = spec.get("max_pages", DEFAULT_MAX_PAGES)
+
+    def fetch(params):
+        return make_api_call(
+            with_params(url, params),
+            call["method"],
+            body=call.get("body"),
+            base_url=base_url,
+            env=env,
+        )
+
+    if spec.get("style") == "cursor":
+        pages = fetch_cursor_pages(spec, fetch, max_pages)
+    else:
+        pages = fetch_offset_pages(spec, fetch, max_pages, page_executor)
+    if not pages or any(page is None for page in pages):
+        return None
+
+    response = pages[0]
+    items = []
+    for page in pages:
+        items.extend(get_path(page, items_path) or [])
+    set_path(response, items_path, items)
+    if spec.get("style") == "cursor":
+        # Cursors are opaque and differ between runs, so they are not compared
+        set_path(response, spec.get("next_cursor_path", "next_cursor"), None)
+
+    c_print.cyan(f"Fetched {len(pages)} pages ({len(items)} items) for {url}")
+    return response
+
+
+def fetch_cursor_pages(spec, fetch, max_pages):
+    cursor_param = spec.get("cursor_param", "cursor")
+    next_cursor_path = spec.get("next_cursor_path", "next_cursor")
+
+    # Each page names the next one, so cursor pages are fetched in sequence
+    pages = [fetch({})]
+    while pages[-1] is not None:
+        cursor = get_path(pages[-1], next_cursor_path)
+        if not cursor:
+            break
+        if len(pages) >= max_pages:
+            c_print.warn(f"Stopped after max_pages ({max_pages}) pages")
+            break
+        pages.append(fetch({cursor_param: cursor}))
+    return pages
+
+
+def fetch_offset_pages(spec, fetch, max_pages, page_executor):
+    limit_param = spec.get("limit_param", "limit")
+    offset_param = spec.get("offset_param", "offset")
+    page_size = spec.get("page_size", DEFAULT_PAGE_SIZE)
+    items_path = spec.get("items_path", "data")
+    total_path = spec.get("total_path")
+
+    def fetch_page(offset):
+        return fetch({limit_param: page_size, offset_param: offset})
+
+    first_page = fetch_page(0)
+    if first_page is None:
+        return [first_page]
+
+    total = get_path(first_page, total_path) if total_path else None
+    if isinstance(total, int):
+        # The total gives every offset up front, so the remaining pages are
+        # fetched concurrently
+        offsets = list(range(page_size, total, page_size))
+        if len(offsets) >= max_pages:
+            c_print.warn(f"Stopped after max_pages ({max_pages}) pages")
+            offsets = offsets[: max_pages - 1]
+        return [first_page, *page_executor.map(fetch_page, offsets)]
+
+    # Without a total, keep going until a short page
+    pages = [first_page]
+    while len(get_path(pages[-1], items_path) or []) >= page_size:
+        if len(pages) >= max_pages:
+            c_print.warn(f"Stopped after max_pages ({max_pages}) pages")
+            break
+        page = fetch_page(len(pages) * page_size)
+        pages.append(page)
+        if page is None:
+            break
+    return pages
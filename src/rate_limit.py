@@ -0,0 +1,69 @@
+import contextvars
+import threading
+import time
+
+# Requests per second and burst size per environment. Environments without
+# an entry are not throttled client-side until configure_rate_limit is called.
+DEFAULT_RATE_LIMITS = {}
+
+
+class RateLimiter:
+    # Token bucket shared by every worker thread hitting one environment. A
+    # rate of 0 disables throttling, but hold() still pauses all callers,
+    # which is how a 429/503 with Retry-After backs off the whole run.
+    def __init__(self, rate=0, burst=0):
+        self.rate = rate
+        self.capacity = max(1, burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.held_until = 0.0
+        self._lock = threading.Lock()
+
+    def hold(self, seconds):
+        with self._lock:
+            self.held_until = max(self.held_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self.held_until - now
+                if wait <= 0 and not self.rate:
+                    return
+                if wait <= 0:
+                    elapsed = now - self.updated
+                    self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# Limiters set by configure_rate_limit, which apply to the run that set them
+# (and the threads that adopt its context) rather than the whole process, so
+# concurrent jobs in one process (serve) never replace each other's limits
+_configured_limiters = contextvars.ContextVar("configured_limiters", default={})
+
+
+def configure_rate_limit(env, rate, burst=0):
+    limiters = dict(_configured_limiters.get())
+    limiters[env] = RateLimiter(rate, burst)
+    _configured_limiters.set(limiters)
+
+
+def get_rate_limiter(env):
+    limiter = _configured_limiters.get().get(env)
+    if limiter is not None:
+        return limiter
+    with _limiters_lock:
+        limiter = _limiters.get(env)
+        if limiter is None:
+            limiter = _limiters[env] = RateLimiter(
+                *DEFAULT_RATE_LIMITS.get(env, (0, 0))
+            )
+        return limiter
@@ -0,0 +1,116 @@
+import json
+import time
+from datetime import datetime
+from db import ResponseStore, CANONICAL_HASH_LIMIT, parse_json
+from diff_cache import configure_diff_cache, diff_options, DEFAULT_CACHE_SIZE_MB
+from hashing import canonical_hash
+from main import summarize_run
+from metrics import metrics
+from output import c_print
+from shards import parse_shard, outside_shard
+from synthesize_results import THRESHOLD
+from user_input_client import is_valid_json, make_calls_list
+from utils import compare_responses, load_json_file
+
+
+def changed_calls(old_calls, new_calls):
+    # Calls are matched by eid; only the options that shape a diff can change
+    old_by_eid = {call["eid"]: call for call in old_calls}
+    new_by_eid = {call["eid"]: call for call in new_calls}
+    if set(old_by_eid) != set(new_by_eid):
+        raise ValueError(
+            "recompare can only change the options of the run's calls, "
+            "not add or remove calls."
+        )
+    return [
+        new_by_eid[eid]
+        for eid in new_by_eid
+        if diff_options(new_by_eid[eid]) != diff_options(old_by_eid[eid])
+    ]
+
+
+def content_hash(text, exclude_paths):
+    # As at fetch time: no hash for empty, unparseable or oversized bodies
+    if not text or len(text) > CANONICAL_HASH_LIMIT:
+        return None
+    try:
+        response = parse_json(text)
+    except ValueError:
+        return None
+    return canonical_hash(response, exclude_paths) if response else None
+
+
+def rehash_responses(store, cids, calls, skip=None):
+    # Stored hashes leave out the old exclude_paths, so they are recomputed
+    # from the stored payloads before the unchanged-pair fast path sees them
+    skip = skip or set()
+    for call in calls:
+        exclude_paths = call.get("exclude_paths")
+        for cid in cids:
+            if (cid, call["eid"]) in skip:
+                continue
+            response_before, response_after = store.get_responses(cid, call["eid"])
+            store.set_hashes(
+                cid,
+                call["eid"],
+                content_hash(response_before, exclude_paths),
+                content_hash(response_after, exclude_paths),
+            )
+    store.flush()
+
+
+def recompare_run(
+    test_run_dir,
+    config_path="",
+    summary_type="endpoint",
+    threshold=THRESHOLD,
+    diff_workers=0,
+    diff_cache_size=DEFAULT_CACHE_SIZE_MB,
+):
+    # Re-diffs an existing run from its responses.db, without any requests.
+    # Only pairs of calls whose diff options changed in the new config are
+    # diffed again; every other result is kept. The summary is always
+    # regenerated, so a new summary_type or threshold needs no config at all.
+    run_start = time.perf_counter()
+    metrics.reset()
+    configure_diff_cache(diff_cache_size)
+
+    config_file = load_json_file(f"{test_run_dir}/config.json")
+    cids = config_file["cids"]
+    calls = config_file["calls"]
+
+    changed = []
+    if config_path:
+        loaded_data = load_json_file(config_path)
+        if not is_valid_json(loaded_data):
+            raise ValueError(f"Invalid config file '{config_path}'.")
+        if loaded_data["cids"] != cids:
+            c_print.warn("Ignoring cids in the new config; the run's cids are kept")
+        new_calls = make_calls_list(loaded_data["calls"])
+        changed = changed_calls(calls, new_calls)
+        calls = new_calls
+
+    if changed:
+        c_print.blue(
+            f"Options changed for {[call['eid'] for call in changed]}, re-comparing..."
+        )
+        # A sharded run only holds its own shard's pairs
+        skip = outside_shard(cids, changed, parse_shard(config_file.get("shard")))
+        store = ResponseStore(f"{test_run_dir}/responses.db")
+        rehash_responses(store, cids, changed, skip)
+        with metrics.timer("phase_seconds", phase="compare"):
+            compare_responses(
+                test_run_dir, store, cids, changed, diff_workers, skip=skip
+            )
+        store.close()
+
+        # Later recompares diff against these options
+        config_file["calls"] = calls
+        config_file["recompared_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with open(f"{test_run_dir}/config.json", "w", encoding="utf-8") as f:
+            json.dump(config_file, f, ensure_ascii=False, indent=4)
+    else:
+        c_print.blue("No diff options changed, re-summarizing only")
+
+    summarize_run(test_run_dir, summary_type, threshold)
+    c_print.ok(f"Recompare completed in {time.perf_counter() - run_start:.1f}s")
@@ -0,0 +1,43 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+DEFAULT_POOL_SIZE = 10
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_pool_size = DEFAULT_POOL_SIZE
+
+
+def configure_pool_size(pool_size):
+    # Only affects sessions created after this call
+    global _pool_size
+    _pool_size = max(1, pool_size)
+
+
+def _new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # urllib3 only advertises the encodings it can decode (br needs brotli)
+    session.headers.update(make_headers(keep_alive=True, accept_encoding=True))
+    return session
+
+
+def get_session(base_url):
+    # One keep-alive session per host, shared by every thread in the process
+    with _sessions_lock:
+        session = _sessions.get(base_url)
+        if session is None:
+            session = _new_session()
+            _sessions[base_url] = session
+        return session
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
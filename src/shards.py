@@ -0,0 +1,53 @@
+import zlib
+from output import c_print
+
+# A shard spec "i/N" picks the i-th of N disjoint slices of the cid x call
+# matrix (1-based). Cells are assigned by a stable hash of cid and eid, so
+# every host computes the same partition without coordinating.
+
+
+def parse_shard(spec):
+    if not spec:
+        return None
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{spec}'. Use the form i/N, e.g. 2/4.")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{spec}'. i must be between 1 and N.")
+    return index, count
+
+
+def in_shard(cid, eid, shard):
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(f"{cid}:{eid}".encode("utf-8")) % count == index - 1
+
+
+def outside_shard(cids, calls, shard):
+    # The (cid, eid) pairs belonging to other shards, as a skip set
+    return {
+        (cid, call["eid"])
+        for cid in cids
+        for call in calls
+        if not in_shard(cid, call["eid"], shard)
+    }
+
+
+def check_shard_coverage(specs):
+    # Merging the same shard twice, or shards of different splits, is an
+    # error. Missing shards are allowed, as their cells were never requested.
+    shards = [parse_shard(spec) for spec in specs if spec]
+    if not shards:
+        return
+    counts = {count for _, count in shards}
+    if len(counts) > 1 or len(shards) != len(specs):
+        raise ValueError("Only shards of the same i/N split can be merged.")
+    indexes = [index for index, _ in shards]
+    if len(set(indexes)) != len(indexes):
+        raise ValueError("The same shard cannot be merged twice.")
+    count = counts.pop()
+    missing = sorted(set(range(1, count + 1)) - set(indexes))
+    if missing:
+        c_print.warn(f"Shards {missing} of {count} are missing from the merge")
@@ -0,0 +1,300 @@
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from auth import configure_headless, get_auth_token
+from db import ResponseStore, DEFAULT_BATCH_SIZE
+from diff_cache import configure_diff_cache, DEFAULT_CACHE_SIZE_MB
+from main import execute_api_calls, summarize_run, write_run_metrics
+from metrics import metrics
+from output import c_print
+from rate_limit import configure_rate_limit
+from sessions import configure_pool_size, close_sessions
+from shards import parse_shard, check_shard_coverage
+from user_input_client import is_valid_json, make_config
+from utils import (
+    compare_responses,
+    create_run_directory,
+    load_json_file,
+    report_run_duration,
+)
+
+# A snapshot is one phase of a run in a single SQLite file: the responses.db
+# schema with every response on the "before" side, plus a snapshot_meta table
+# holding the config it was taken with. Any two snapshots can be compared.
+SNAPSHOT_FORMAT = 1
+
+
+def write_snapshot_meta(snapshot_path, meta):
+    conn = sqlite3.connect(snapshot_path)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS snapshot_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """
+    )
+    conn.executemany(
+        """
+        INSERT INTO snapshot_meta (key, value) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET value = excluded.value
+        """,
+        [(key, json.dumps(value)) for key, value in meta.items()],
+    )
+    conn.commit()
+    conn.close()
+
+
+def read_snapshot_meta(snapshot_path):
+    if not os.path.isfile(snapshot_path):
+        raise FileNotFoundError(f"Snapshot '{snapshot_path}' does not exist.")
+    conn = sqlite3.connect(snapshot_path)
+    try:
+        rows = conn.execute("SELECT key, value FROM snapshot_meta").fetchall()
+    except sqlite3.DatabaseError:
+        raise ValueError(f"'{snapshot_path}' is not a snapshot.")
+    finally:
+        conn.close()
+    meta = {key: json.loads(value) for key, value in rows}
+    if meta.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"'{snapshot_path}' has an unsupported snapshot format.")
+    return meta
+
+
+def finish_snapshot(snapshot_path, meta):
+    write_snapshot_meta(snapshot_path, meta)
+    # Leave a single self-contained file, without -wal and -shm companions
+    conn = sqlite3.connect(snapshot_path)
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+
+
+def exclude_paths_by_eid(calls):
+    return {call["eid"]: sorted(call.get("exclude_paths") or []) for call in calls}
+
+
+def take_snapshot(
+    snapshot_path,
+    env="",
+    config_path="",
+    concurrency=1,
+    pool_size=0,
+    batch_size=DEFAULT_BATCH_SIZE,
+    rate_limit=0.0,
+    burst=0,
+    headless=False,
+    totp_file="",
+    token_file="",
+    prometheus_textfile="",
+    shard="",
+):
+    metrics.reset()
+    configure_pool_size(pool_size or concurrency)
+    configure_headless(headless, totp_file, token_file)
+
+    if os.path.exists(snapshot_path):
+        # Finish an interrupted snapshot, with the config it was started with
+        meta = read_snapshot_meta(snapshot_path)
+        c_print.blue(f"Resuming snapshot {snapshot_path}")
+    else:
+        loaded_data = load_json_file(config_path)
+        if not is_valid_json(loaded_data):
+            raise ValueError(f"Invalid config file '{config_path}'.")
+        config = make_config(env, loaded_data["cids"], loaded_data["calls"])
+        meta = {
+            "format": SNAPSHOT_FORMAT,
+            "env": env,
+            "config": config,
+            "exclude_paths": exclude_paths_by_eid(config["calls"]),
+            "taken_at": config["run_start"],
+        }
+        if shard:
+            meta["shard"] = shard
+        write_snapshot_meta(snapshot_path, meta)
+        c_print.blue(f"Snapshot will be written to {snapshot_path}")
+
+    config = meta["config"]
+    if rate_limit:
+        configure_rate_limit(meta["env"], rate_limit, burst)
+
+    store = ResponseStore(snapshot_path, batch_size)
+    stored = store.successful_responses(before=True)
+    with metrics.timer("phase_seconds", phase="snapshot"):
+        execute_api_calls(
+            config["cids"],
+            config["calls"],
+            config["base_url"],
+            "before",
+            meta["env"],
+            store,
+            concurrency,
+            skip=stored,
+            shard=parse_shard(meta.get("shard")),
+        )
+    store.close()
+
+    meta["completed_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    meta["metrics"] = metrics.snapshot()
+    finish_snapshot(snapshot_path, meta)
+    if prometheus_textfile:
+        metrics.write_prometheus(prometheus_textfile)
+    c_print.ok(f"Snapshot written to {snapshot_path}")
+
+
+def take_local_shards(
+    snapshot_path,
+    local_shards,
+    env="",
+    config_path="",
+    concurrency=1,
+    pool_size=0,
+    batch_size=DEFAULT_BATCH_SIZE,
+    rate_limit=0.0,
+    burst=0,
+    headless=False,
+    totp_file="",
+    token_file="",
+):
+    # A stand-in for a sweep spread across hosts: each shard is snapshotted by
+    # its own process into its own file, and the files are merged at the end.
+    # Limits like --concurrency and --rate-limit apply to each shard.
+    shard_paths = [
+        f"{snapshot_path}.shard{index}of{local_shards}"
+        for index in range(1, local_shards + 1)
+    ]
+
+    # Log in once up front, so the shards share the saved token rather than
+    # each prompting for one
+    configure_headless(headless, totp_file, token_file)
+    get_auth_token(env)
+    # The login leaves a pooled connection to the API's host, which forked
+    # shards would otherwise all read and write on at once
+    close_sessions()
+
+    with ProcessPoolExecutor(max_workers=local_shards) as executor:
+        futures = [
+            executor.submit(
+                take_snapshot,
+                shard_path,
+                env,
+                config_path,
+                concurrency,
+                pool_size,
+                batch_size,
+                rate_limit,
+                burst,
+                headless,
+                totp_file,
+                token_file,
+                shard=f"{index}/{local_shards}",
+            )
+            for index, shard_path in enumerate(shard_paths, start=1)
+        ]
+        for future in futures:
+            future.result()
+
+    merge_snapshots(snapshot_path, shard_paths)
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+
+
+def merge_snapshots(snapshot_path, shard_paths):
+    # Combines snapshots of the same config, e.g. one per shard, into one
+    metas = [read_snapshot_meta(shard_path) for shard_path in shard_paths]
+    meta = dict(metas[0])
+    for shard_path, shard_meta in zip(shard_paths, metas):
+        if shard_meta["config"]["calls"] != meta["config"]["calls"] or (
+            shard_meta["config"]["cids"] != meta["config"]["cids"]
+        ):
+            raise ValueError(f"'{shard_path}' was taken with a different config.")
+    check_shard_coverage([shard_meta.get("shard") for shard_meta in metas])
+
+    meta.pop("shard", None)
+    meta.pop("metrics", None)
+    meta["merged_from"] = [os.path.abspath(shard_path) for shard_path in shard_paths]
+    meta["taken_at"] = min(shard_meta["taken_at"] for shard_meta in metas)
+    completed = [shard_meta.get("completed_at") for shard_meta in metas]
+    if all(completed):
+        meta["completed_at"] = max(completed)
+    else:
+        meta.pop("completed_at", None)
+
+    if os.path.exists(snapshot_path):
+        raise FileExistsError(f"'{snapshot_path}' already exists.")
+    write_snapshot_meta(snapshot_path, meta)
+    store = ResponseStore(snapshot_path)
+    for shard_path in shard_paths:
+        store.copy_responses(shard_path, {"before": "before"})
+    store.close()
+    finish_snapshot(snapshot_path, meta)
+    c_print.ok(f"Merged {len(shard_paths)} snapshots into {snapshot_path}")
+
+
+def compare_snapshots(
+    before_path,
+    after_path,
+    output_dir="",
+    summary_type="endpoint",
+    diff_workers=0,
+    batch_size=DEFAULT_BATCH_SIZE,
+    prometheus_textfile="",
+    diff_cache_size=DEFAULT_CACHE_SIZE_MB,
+    executor=None,
+):
+    run_start = time.perf_counter()
+    metrics.reset()
+    configure_diff_cache(diff_cache_size)
+
+    before_meta = read_snapshot_meta(before_path)
+    after_meta = read_snapshot_meta(after_path)
+    for path, meta in [(before_path, before_meta), (after_path, after_meta)]:
+        if not meta.get("completed_at"):
+            c_print.warn(f"Snapshot {path} was not completed")
+
+    # The "before" snapshot's config decides which pairs are compared and how
+    config = dict(before_meta["config"])
+    config["run_start"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    config["before_snapshot"] = os.path.abspath(before_path)
+    config["after_snapshot"] = os.path.abspath(after_path)
+    config["after_env"] = after_meta["env"]
+
+    test_run_dir = create_run_directory(after_meta["env"], output_dir)
+    c_print.blue(f"Comparison will output at {test_run_dir}")
+    with open(f"{test_run_dir}/config.json", "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+
+    store = ResponseStore(f"{test_run_dir}/responses.db", batch_size)
+    # Payloads stay in the snapshot files; only the rows are copied
+    store.link_responses(before_path, {"before": "before"})
+    store.link_responses(after_path, {"before": "after"})
+
+    # Canonical hashes leave out each snapshot's exclude_paths, so they can
+    # only be trusted where both snapshots excluded the same paths
+    mismatched = [
+        eid
+        for eid, exclude_paths in before_meta["exclude_paths"].items()
+        if after_meta["exclude_paths"].get(eid, exclude_paths) != exclude_paths
+    ]
+    if mismatched:
+        c_print.warn(f"exclude_paths differ between snapshots for {mismatched}")
+        store.clear_hashes(mismatched)
+
+    c_print.blue("Comparing snapshots...")
+    with metrics.timer("phase_seconds", phase="compare"):
+        compare_responses(
+            test_run_dir,
+            store,
+            config["cids"],
+            config["calls"],
+            diff_workers,
+            executor=executor,
+        )
+    store.close()
+
+    summarize_run(test_run_dir, summary_type)
+    write_run_metrics(test_run_dir, run_start, prometheus_textfile)
+    report_run_duration(test_run_dir)
+    return test_run_dir
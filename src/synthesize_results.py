@@ -1,160 +1,197 @@
-from typing import Any, Dict, List
-
-
-def calculate_percentage_difference(old_value: Any, new_value: Any) -> float:
-    try:
-        if isinstance(old_value, (int, float)) and isinstance(new_value, (int, float)):
-            return (
-                abs(new_value - old_value) / max(abs(old_value), abs(new_value))
-            ) * 100
-        else:
-            return 0.0
-    except ZeroDivisionError:
-        # choosing not to do infinite percentage difference, rather 0.0
-        return 0.0
-
-
-def process_arrays(old_items: List[Dict], new_items: List[Dict]) -> float:
-    changes = []
-    for idx, (old, new) in enumerate(zip(old_items, new_items)):
-        for key in set(old.keys()).union(new.keys()):
-            old_val = old.get(key)
-            new_val = new.get(key)
-            if isinstance(old_val, (int, float)) and isinstance(new_val, (int, float)):
-                change_percentage = calculate_percentage_difference(old_val, new_val)
-                changes.append(change_percentage)
-    return sum(changes) / len(changes) if changes else 0.0
-
-
-def append_threshold_warning(
-    change_magnitude: float,
-    identifier_string: str,
-    change_path_string,
-    threshold_warnings: Dict[str, Dict[str, float]],
-) -> Dict[str, Dict[str, float]]:
-    if change_magnitude > 5:
-        if not threshold_warnings.get(identifier_string):
-            threshold_warnings[identifier_string] = {}
-        threshold_warnings[identifier_string][change_path_string] = change_magnitude
-    return threshold_warnings
-
-
-def summarize_all_changes(deepdiff_results: Dict[str, Any]) -> Dict[str, float]:
-    results = {}
-    threshold_warnings = {}
-    for cid_index_endpoint, change_obj in deepdiff_results["all_results"].items():
-        all_changes = []
-        values_changed = change_obj.get("values_changed")
-        if values_changed:  # There are changes to process
-            for change_path_string, change_value_object in values_changed.items():
-                old_value = change_value_object["old_value"]
-                new_value = change_value_object["new_value"]
-                if isinstance(old_value, list) and isinstance(new_value, list):
-                    array_change_averages = process_arrays(old_value, new_value)
-                    threshold_warnings = append_threshold_warning(
-                        array_change_averages,
-                        cid_index_endpoint,
-                        change_path_string,
-                        threshold_warnings,
-                    )
-                    all_changes.append(array_change_averages)
-                elif isinstance(old_value, (int, float)) and isinstance(
-                    new_value, (int, float)
-                ):
-                    change_percentage = calculate_percentage_difference(
-                        old_value, new_value
-                    )
-                    threshold_warnings = append_threshold_warning(
-                        change_percentage,
-                        cid_index_endpoint,
+import json
+from typing import Any, Dict, Iterator, List, Tuple
+import numpy as np
+
+# Changes above this percentage are reported in warnings.json
+THRESHOLD = 5
+
+# What the summaries average. Every numeric values_changed path is a scalar
+# entry; one between two arrays is an array entry worth the average change
+# of the numbers in their records. A result without values_changed counts
+# as a single NO_CHANGES entry worth 0.0. Other changes are not averaged.
+NO_CHANGES = 0
+SCALAR_CHANGE = 1
+ARRAY_CHANGE = 2
+OTHER_CHANGE = 3
+
+# The value_type each kind is written to the changes table with
+VALUE_TYPES = {SCALAR_CHANGE: "number", ARRAY_CHANGE: "array"}
+
+
+def is_number(value: Any) -> bool:
+    return isinstance(value, (int, float))
+
+
+def report_values(report: str, detail: Any) -> Tuple[Any, Any]:
+    # The (old, new) values of one entry of a DeepDiff report. Reports that
+    # are lists of paths, like dictionary_item_added, carry no values.
+    if isinstance(detail, dict) and ("old_value" in detail or "new_value" in detail):
+        return detail.get("old_value"), detail.get("new_value")
+    if report.endswith("_removed"):
+        return detail, None
+    if report.endswith("_added"):
+        return None, detail
+    return None, None
+
+
+def extract_changes(deepdiff_results: Dict[str, Any]) -> Dict[str, Any]:
+    # One walk over every result, with an entry for every path of every
+    # report. Entries are tagged with cid, endpoint, report, path and kind;
+    # the numeric (old, new) pairs behind them are flattened into columns,
+    # with pair_entry pointing each pair back at its entry.
+    entries: List[Tuple[str, str, str, str, int]] = []
+    entry_old: List[Any] = []
+    entry_new: List[Any] = []
+    pair_entry: List[int] = []
+    pair_old: List[float] = []
+    pair_new: List[float] = []
+
+    def add_entry(cid, endpoint, report, path, kind, old_value, new_value):
+        entries.append((cid, endpoint, report, path, kind))
+        entry_old.append(old_value)
+        entry_new.append(new_value)
+
+    for cid, endpoint_changes in deepdiff_results["results_by_cid"].items():
+        for endpoint, change_obj in endpoint_changes.items():
+            if not isinstance(change_obj, dict):
+                add_entry(cid, endpoint, "none", "", NO_CHANGES, None, None)
+                continue
+            if not change_obj.get("values_changed"):
+                add_entry(cid, endpoint, "none", "", NO_CHANGES, None, None)
+            for report, details in change_obj.items():
+                if isinstance(details, dict):
+                    items = details.items()
+                else:
+                    items = ((path, None) for path in details or [])
+                for change_path_string, detail in items:
+                    old_value, new_value = report_values(report, detail)
+                    kind = OTHER_CHANGE
+                    if report == "values_changed":
+                        if isinstance(old_value, list) and isinstance(new_value, list):
+                            kind = ARRAY_CHANGE
+                        elif is_number(old_value) and is_number(new_value):
+                            kind = SCALAR_CHANGE
+                    if kind == ARRAY_CHANGE:
+                        for old_row, new_row in zip(old_value, new_value):
+                            if not (
+                                isinstance(old_row, dict) and isinstance(new_row, dict)
+                            ):
+                                continue
+                            for key, old_val in old_row.items():
+                                new_val = new_row.get(key)
+                                if is_number(old_val) and is_number(new_val):
+                                    pair_entry.append(len(entries))
+                                    pair_old.append(old_val)
+                                    pair_new.append(new_val)
+                    elif kind == SCALAR_CHANGE:
+                        pair_entry.append(len(entries))
+                        pair_old.append(old_value)
+                        pair_new.append(new_value)
+                    add_entry(
+                        cid,
+                        endpoint,
+                        report,
                         change_path_string,
-                        threshold_warnings,
+                        kind,
+                        old_value,
+                        new_value,
                     )
-                    all_changes.append(change_percentage)
-        else:  # No changes, treat as 0 change
-            all_changes.append(0.0)
-        if all_changes:
-            # Calculate average of all changes for this cid_index_endpoint
-            results[cid_index_endpoint] = sum(all_changes) / len(all_changes)
-    return results, threshold_warnings
 
+    return {
+        "entries": entries,
+        "entry_old": entry_old,
+        "entry_new": entry_new,
+        "pair_entry": np.array(pair_entry, dtype=np.int64),
+        "pair_old": np.array(pair_old, dtype=np.float64),
+        "pair_new": np.array(pair_new, dtype=np.float64),
+    }
 
-def summarize_changes_by_endpoint(deepdiff_results: Dict[str, Any]) -> Dict[str, float]:
-    results = {}
-    threshold_warnings = {}
-    for endpoint, cid_changes in deepdiff_results["results_by_endpoint"].items():
-        all_changes = []
-        for cid, change_obj in cid_changes.items():
-            values_changed = change_obj.get("values_changed")
-            if values_changed:  # There are changes to process
-                for change_path_string, change_value_object in values_changed.items():
-                    old_value = change_value_object["old_value"]
-                    new_value = change_value_object["new_value"]
-                    if isinstance(old_value, list) and isinstance(new_value, list):
-                        all_changes.append(process_arrays(old_value, new_value))
-                    elif isinstance(old_value, (int, float)) and isinstance(
-                        new_value, (int, float)
-                    ):
-                        percentage_difference = calculate_percentage_difference(
-                            old_value, new_value
-                        )
-                        threshold_warnings = append_threshold_warning(
-                            percentage_difference,
-                            f"{endpoint}-{cid}",
-                            change_path_string,
-                            threshold_warnings,
-                        )
-                        all_changes.append(percentage_difference)
-            else:  # No changes, treat as 0 change
-                all_changes.append(0.0)
-        if all_changes:
-            results[endpoint] = sum(all_changes) / len(all_changes)
-    return results, threshold_warnings
+
+def percentage_differences(old: np.ndarray, new: np.ndarray) -> np.ndarray:
+    # Relative to the larger magnitude; 0.0 rather than infinite when both are 0
+    magnitude = np.maximum(np.abs(old), np.abs(new))
+    return (
+        np.divide(
+            np.abs(new - old),
+            magnitude,
+            out=np.zeros_like(magnitude),
+            where=magnitude > 0,
+        )
+        * 100
+    )
 
 
-def summarize_changes_by_cid(deepdiff_results: Dict[str, Any]) -> Dict[str, float]:
-    results = {}
-    threshold_change = {}
-    for cid, endpoints_changes in deepdiff_results["results_by_cid"].items():
-        all_changes = []
-        for endpoint, change_obj in endpoints_changes.items():
-            values_changed = change_obj.get("values_changed")
-            if values_changed:  # There are changes to process
-                for change_path_string, change_value_object in values_changed.items():
-                    old_value = change_value_object["old_value"]
-                    new_value = change_value_object["new_value"]
-                    if isinstance(old_value, list) and isinstance(new_value, list):
-                        all_changes.append(process_arrays(old_value, new_value))
-                    elif isinstance(old_value, (int, float)) and isinstance(
-                        new_value, (int, float)
-                    ):
-                        percentage_change = calculate_percentage_difference(
-                            old_value, new_value
-                        )
-                        threshold_change = append_threshold_warning(
-                            percentage_change,
-                            f"{cid}-{endpoint}",
-                            change_path_string,
-                            threshold_change,
-                        )
-                        all_changes.append(percentage_change)
-            else:  # No changes, treat as 0 change
-                all_changes.append(0.0)
-        if all_changes:
-            results[cid] = sum(all_changes) / len(all_changes)
-    return results, threshold_change
-
-
-def process_deepdiff_output(
-    deepdiff_results: Dict[str, Any], summary_type: str
-) -> Dict[str, float]:
-    if summary_type == "endpoint":
-        return summarize_changes_by_endpoint(deepdiff_results)
-    elif summary_type == "cid":
-        return summarize_changes_by_cid(deepdiff_results)
-    elif summary_type == "changes":
-        return summarize_all_changes(deepdiff_results)
-    else:
+def entry_magnitudes(changes: Dict[str, Any]) -> np.ndarray:
+    # Scalar entries take their own percentage, array entries the average
+    # over their numeric pairs, and every other entry 0.0
+    entry_count = len(changes["entries"])
+    pair_pct = percentage_differences(changes["pair_old"], changes["pair_new"])
+    totals = np.bincount(changes["pair_entry"], weights=pair_pct, minlength=entry_count)
+    counts = np.bincount(changes["pair_entry"], minlength=entry_count)
+    return np.divide(totals, counts, out=np.zeros(entry_count), where=counts > 0)
+
+
+def change_rows(deepdiff_results: Dict[str, Any]) -> Iterator[Tuple]:
+    # Rows for the changes table, one per entry in entry order. pct_change is
+    # the magnitude the summaries average, and NULL for changes they do not.
+    changes = extract_changes(deepdiff_results)
+    magnitudes = entry_magnitudes(changes)
+    for index, (cid, endpoint, report, path, kind) in enumerate(changes["entries"]):
+        old_value = changes["entry_old"][index]
+        new_value = changes["entry_new"][index]
+        yield (
+            cid,
+            endpoint,
+            report,
+            path,
+            None if old_value is None else json.dumps(old_value),
+            None if new_value is None else json.dumps(new_value),
+            None if kind == OTHER_CHANGE else float(magnitudes[index]),
+            VALUE_TYPES.get(kind),
+        )
+
+
+# For each summary type: the SQL expression rows are grouped by, the key of a
+# warning, and the value types that can raise one
+TABLE_SUMMARIES = {
+    "all": (
+        "customer_id || '_' || endpoint",
+        lambda cid, endpoint: f"{cid}_{endpoint}",
+        ["number", "array"],
+    ),
+    "endpoint": (
+        "endpoint",
+        lambda cid, endpoint: f"{endpoint}-{cid}",
+        ["number"],
+    ),
+    "cid": (
+        "customer_id",
+        lambda cid, endpoint: f"{cid}-{endpoint}",
+        ["number"],
+    ),
+}
+TABLE_SUMMARIES["changes"] = TABLE_SUMMARIES["all"]
+
+
+def summarize_change_table(
+    store, summary_type: str, threshold: float = THRESHOLD
+) -> Tuple[Dict[str, float], Dict[str, Dict[str, float]]]:
+    # report.json and warnings.json, aggregated in SQL over the changes table
+    # written by change_rows
+    if summary_type not in TABLE_SUMMARIES:
         raise ValueError(
             "Invalid summary type. Please choose 'endpoint', 'cid', or 'all'."
         )
+    group_expr, warning_key, value_types = TABLE_SUMMARIES[summary_type]
+    results = dict(store.change_averages(group_expr))
+
+    # Warnings are ordered by their group's place in the report
+    group_order = {group: index for index, group in enumerate(results)}
+    flagged = store.changes_above(threshold, value_types, group_expr)
+    flagged.sort(key=lambda row: group_order[row["group"]])
+    threshold_warnings: Dict[str, Dict[str, float]] = {}
+    for row in flagged:
+        threshold_warnings.setdefault(
+            warning_key(row["customer_id"], row["endpoint"]), {}
+        )[row["path"]] = row["pct_change"]
+    return results, threshold_warnings
@@ -13,6 +13,11 @@ def make_calls_list(calls):
             "method": call["method"],
             "body": call.get("body"),
             "exclude_paths": call.get("exclude_paths", []),
+            **{
+                option: call[option]
+                for option in ["comparator", "align_key", "tolerance", "pagination"]
+                if option in call
+            },
         }
         for index, call in enumerate(calls)
     ]
@@ -32,9 +37,18 @@ def is_valid_json(data):
     return False
 
 
+def make_config(env, cids, calls):
+    return {
+        "run_start": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "env": env,
+        "base_url": get_url_from_env(env),
+        "cids": cids,
+        "calls": make_calls_list(calls),
+    }
+
+
 def generate_config_json(test_run_dir, env, config_path=None):
     url = get_url_from_env(env)
-    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     if config_path:
         with open(config_path, "r", encoding="utf-8") as f:
@@ -88,12 +102,7 @@ def generate_config_json(test_run_dir, env, config_path=None):
                 calls.append(call)
                 more_calls = input("Add another call? (y/N): ").lower() == "y"
 
-    data = {
-        "run_start": current_time,
-        "base_url": url,
-        "cids": cids,
-        "calls": make_calls_list(calls),
-    }
+    data = make_config(env, cids, calls)
 
     new_config_file = f"{test_run_dir}/config.json"
     with open(new_config_file, "w", encoding="utf-8") as f:
@@ -1,11 +1,23 @@
+import contextvars
 import os
 import json
 import math
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from output import c_print
-from db import get_responses, set_difference
+from db import ResponseStore, parse_json
 from deepdiff import DeepDiff
 from deepdiff.model import PrettyOrderedSet
+from numeric_diff import numeric_diff
+from metrics import metrics, COUNT_BUCKETS
+from diff_cache import DiffCache, diff_cache_spec, open_diff_cache
+
+RESULTS_LOG = "results.jsonl"
+
+# Open stores each diff worker keeps, for the dbs it diffed most recently
+MAX_WORKER_STORES = 4
 
 
 def load_json_file(file_path):
@@ -13,6 +25,22 @@ def load_json_file(file_path):
         return json.load(file)
 
 
+def adopt_context(context):
+    # ThreadPoolExecutor initializer. Worker threads start with an empty
+    # context, so they take on the scoped metrics and rate limits of the run
+    # that made the pool.
+    for var, value in context.items():
+        var.set(value)
+
+
+def thread_pool(max_workers):
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=adopt_context,
+        initargs=(contextvars.copy_context(),),
+    )
+
+
 def create_run_directory(env, output_dir):
     if not output_dir:
         timestamp = math.floor(datetime.now().timestamp())
@@ -28,44 +56,240 @@ def get_url_from_env(env):
         "stg1": "https://staging-console.siftscience.com",
         "prod": "https://console.sift.com",
     }
-    return url_options.get(env, "")
+    # API3_BASE_URL points every env at another host, e.g. a local mock server
+    return os.getenv("API3_BASE_URL") or url_options.get(env, "")
+
 
+def diff_responses(store, cid, call, cache=None):
+    c_print.time("Comparing responses for customer ID:", cid, "Endpoint:", call["url"])
 
-def compare_responses(test_run_dir, db_path, cids, calls):
-    for cid in cids:
-        for call in calls:
-            c_print.time(
-                "Comparing responses for customer ID:", cid, "Endpoint:", call["url"]
+    # Identical content hashes mean there is nothing for DeepDiff to find
+    hash_before, hash_after = store.get_hashes(cid, call["eid"])
+    if hash_before and hash_before == hash_after:
+        return {}
+
+    # Then a diff of the same two payloads with the same options, from this
+    # or any earlier run
+    cache_key = None
+    if cache:
+        blob_before, blob_after = store.get_blob_hashes(cid, call["eid"])
+        if blob_before and blob_after:
+            cache_key = DiffCache.key(blob_before, blob_after, call)
+            diff = cache.get(cache_key)
+            if diff is not None:
+                if diff:
+                    c_print.warn("Differences found (cached).")
+                return diff
+
+    response_before, response_after = store.get_responses(cid, call["eid"])
+
+    diff = "Missing response data"
+
+    try:
+        response_before = parse_json(response_before) if response_before else None
+        response_after = parse_json(response_after) if response_after else None
+    except ValueError:
+        response_before = response_after = None
+    if response_before and response_after:
+        exclude_paths = call.get("exclude_paths", [])
+        if call.get("comparator") == "numeric":
+            diff = numeric_diff(
+                response_before,
+                response_after,
+                call.get("align_key"),
+                call.get("tolerance", 0.0),
+                exclude_paths,
             )
+        else:
+            diff = DeepDiff(
+                response_before,
+                response_after,
+                ignore_order=True,
+                exclude_paths=exclude_paths,
+            )
+            # Plain JSON types pickle cheaply and record without surprises
+            diff = json.loads(json.dumps(diff, cls=CustomJSONEncoder))
+
+        if cache_key:
+            cache.put(cache_key, diff)
+        if diff:
+            c_print.warn("Differences found.")
+
+    return diff
 
-            eid = call["eid"]
-            response_before, response_after = get_responses(db_path, cid, eid)
 
-            diff = "Missing response data"
+def timed_diff(store, cid, call, cache=None):
+    # Diff workers have their own metrics, so the time taken and whether the
+    # diff came from the cache travel back to the parent with the result
+    hits = cache.hits if cache else 0
+    start = time.perf_counter()
+    diff = diff_responses(store, cid, call, cache)
+    cached = bool(cache) and cache.hits > hits
+    return diff, time.perf_counter() - start, cached
 
-            response_before = json.loads(response_before)
-            response_after = json.loads(response_after)
-            if response_before and response_after:
-                exclude_paths = call.get("exclude_paths", [])
-                diff = DeepDiff(
-                    response_before,
-                    response_after,
-                    ignore_order=True,
-                    exclude_paths=exclude_paths,
-                )
 
-                if not diff:
-                    diff = {}
-                else:
-                    # diff = json.dumps(diff, cls=CustomJSONEncoder)
-                    c_print.warn("Differences found.")
+def diff_size(diff):
+    # Number of changes reported, across all report types
+    if not isinstance(diff, dict):
+        return 0
+    return sum(len(report) for report in diff.values())
+
+
+# Each diff worker process keeps its own connection per db, so payloads are
+# read from disk in the worker rather than pickled over from the parent. A
+# long-lived pool (serve) sees a new db per job, so only the most recently
+# used stores stay open. The diff cache is opened the same way, once per
+# process.
+_worker_stores = OrderedDict()
+_worker_caches = {}
+
+
+def _worker_cache(cache_spec):
+    # Keyed by pid too, so a forked worker never uses its parent's connection
+    key = (os.getpid(), cache_spec)
+    if key not in _worker_caches:
+        _worker_caches[key] = open_diff_cache(cache_spec)
+    return _worker_caches[key]
+
+
+def _worker_store(db_path):
+    key = (os.getpid(), db_path)
+    store = _worker_stores.get(key)
+    if store is None:
+        store = _worker_stores[key] = ResponseStore(db_path)
+        while len(_worker_stores) > MAX_WORKER_STORES:
+            (pid, _), evicted = _worker_stores.popitem(last=False)
+            # A forked worker leaves its parent's connections alone
+            if pid == os.getpid():
+                evicted.close()
+    _worker_stores.move_to_end(key)
+    return store
+
+
+def _diff_worker(db_path, cid, call, cache_spec=None):
+    store = _worker_store(db_path)
+    return timed_diff(store, cid, call, _worker_cache(cache_spec))
+
+
+def resolve_diff_workers(diff_workers):
+    # 0 means one worker per core
+    return diff_workers or os.cpu_count() or 1
+
+
+def record_diffs(results_writer, pairs, get_diff):
+    # get_diff returns (diff, seconds, cached), as from timed_diff
+    for cid, call in pairs:
+        eid = call["eid"]
+        try:
+            diff, seconds, cached = get_diff(cid, call)
+            results_writer.write(cid, eid, diff)
+        except Exception as e:
+            c_print.fail(f"Error recording result for {cid}_{eid}: {e}")
+            continue
+        outcome = "changed" if diff else "unchanged"
+        if isinstance(diff, str):
+            outcome = "missing"
+        metrics.counter("diffs_total", outcome=outcome).inc()
+        if cached:
+            metrics.counter("diff_cache_hits_total").inc()
+        metrics.histogram("diff_seconds").observe(seconds)
+        metrics.histogram("diff_changes", COUNT_BUCKETS).observe(diff_size(diff))
+
 
-            # set_difference(db_path, cid, eid, str(diff))
-            try:
-                record_result(test_run_dir, cid, eid, diff)
-            except:
-                c_print.fail(f"Error recording result for {cid}_{eid}")
-    c_print.blue(f"See the complete results in {test_run_dir}/results.json")
+def pending_pairs(cids, calls, skip=None):
+    skip = skip or set()
+    return [
+        (cid, call) for cid in cids for call in calls if (cid, call["eid"]) not in skip
+    ]
+
+
+def submit_diffs(executor, results_writer, store, pairs, cache_spec):
+    # Workers read from the db file, so everything must be committed first
+    store.flush()
+    futures = {
+        (cid, call["eid"]): executor.submit(
+            _diff_worker, store.db_path, cid, call, cache_spec
+        )
+        for cid, call in pairs
+    }
+    # Results are gathered in the same order the pairs were submitted
+    record_diffs(
+        results_writer,
+        pairs,
+        lambda cid, call: futures[(cid, call["eid"])].result(),
+    )
+
+
+def compare_responses(
+    test_run_dir, store, cids, calls, diff_workers=1, skip=None, executor=None
+):
+    # executor is a long-lived pool of diff workers to use instead of
+    # starting one for this comparison
+    results_writer = ResultsWriter(test_run_dir)
+    pairs = pending_pairs(cids, calls, skip)
+    diff_workers = resolve_diff_workers(diff_workers)
+    cache_spec = diff_cache_spec()
+
+    if executor is not None:
+        submit_diffs(executor, results_writer, store, pairs, cache_spec)
+    elif diff_workers > 1:
+        with ProcessPoolExecutor(max_workers=diff_workers) as executor:
+            submit_diffs(executor, results_writer, store, pairs, cache_spec)
+    else:
+        record_diffs(
+            results_writer,
+            pairs,
+            lambda cid, call: timed_diff(store, cid, call, _worker_cache(cache_spec)),
+        )
+
+    results_writer.close()
+
+
+class DiffPipeline:
+    # Diffs each "after" response against its stored "before" while the rest
+    # of the phase is still being fetched. Diff workers read from the db file,
+    # so stored pairs wait here until the store has committed them.
+    def __init__(self, store, diff_workers=1):
+        self.store = store
+        self.executor = ProcessPoolExecutor(
+            max_workers=resolve_diff_workers(diff_workers)
+        )
+        self.futures = {}
+        self._uncommitted = []
+        self._cache_spec = diff_cache_spec()
+        # Start the worker processes now, before any request threads exist
+        self.executor.submit(int).result()
+
+    def submit(self, cid, call):
+        self._uncommitted.append((cid, call))
+        if self.store.pending_writes == 0:
+            self._dispatch()
+
+    def _dispatch(self):
+        for cid, call in self._uncommitted:
+            self.futures[(cid, call["eid"])] = self.executor.submit(
+                _diff_worker, self.store.db_path, cid, call, self._cache_spec
+            )
+        self._uncommitted = []
+
+    def finish(self, test_run_dir, cids, calls, skip=None):
+        self.store.flush()
+        self._dispatch()
+
+        pairs = pending_pairs(cids, calls, skip)
+        for cid, call in pairs:
+            if (cid, call["eid"]) not in self.futures:
+                self._uncommitted.append((cid, call))
+        self._dispatch()
+
+        results_writer = ResultsWriter(test_run_dir)
+        record_diffs(
+            results_writer,
+            pairs,
+            lambda cid, call: self.futures[(cid, call["eid"])].result(),
+        )
+        results_writer.close()
+        self.executor.shutdown()
 
 
 def report_run_duration(test_run_dir):
@@ -83,34 +307,58 @@ def report_run_duration(test_run_dir):
         json.dump(data, file, indent=4)
 
 
-def record_result(test_run_dir, cid, endpoint, result):
-    # check if the results.json exists
+class ResultsWriter:
+    # Streams one JSON line per (cid, endpoint) to results.jsonl as results
+    # come in, instead of rewriting results.json for every pair, which is only
+    # built once, by materialize_results.
+    def __init__(self, test_run_dir):
+        self.file = open(os.path.join(test_run_dir, RESULTS_LOG), "a", encoding="utf-8")
+
+    def write(self, cid, endpoint, result):
+        # Serialize first so a failure never leaves half a line in the log
+        line = json.dumps(
+            {"cid": cid, "eid": endpoint, "result": result}, cls=CustomJSONEncoder
+        )
+        self.file.write(line + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_results(test_run_dir):
+    # Later lines win, so re-recorded pairs replace their earlier result
+    results = {}
+    results_log = os.path.join(test_run_dir, RESULTS_LOG)
+    if os.path.exists(results_log):
+        with open(results_log, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    results[(record["cid"], record["eid"])] = record["result"]
+    return results
+
+
+def build_results(results):
+    # results.json only holds the by-cid view; anything keyed differently is
+    # derived from it rather than stored alongside
+    results_by_cid = {}
+    total_diffs = 0
+    for (cid, endpoint), result in results.items():
+        results_by_cid.setdefault(cid, {})[endpoint] = result
+        if not result == {}:
+            total_diffs += 1
+    return {"total_diffs": total_diffs, "results_by_cid": results_by_cid}
+
+
+def materialize_results(test_run_dir):
+    deepdiff_results = build_results(read_results(test_run_dir))
+
     results_file = os.path.join(test_run_dir, "results.json")
-    if os.path.exists(results_file):
-        try:
-            with open(results_file, "r") as file:
-                results = json.load(file)
-        except:
-            c_print.fail(f"Error reading results.json for {cid}_{endpoint}")
-            return
-    else:
-        results = {
-            "all_results": {},
-            "results_by_cid": {},
-            "results_by_endpoint": {},
-            "total_diffs": 0,
-        }
-
-    # update the results with the new result
-    results["all_results"][f"{cid}_{endpoint}"] = result
-    results["results_by_cid"].setdefault(cid, {})[endpoint] = result
-    results["results_by_endpoint"].setdefault(endpoint, {})[cid] = result
-    if not result == {}:
-        results["total_diffs"] += 1
-
-    # write the updated results back to the file
     with open(results_file, "w") as file:
-        json.dump(results, file, indent=4)
+        json.dump(deepdiff_results, file, indent=4)
+    c_print.blue(f"See the complete results in {results_file}")
+    return deepdiff_results
 
 
 # TODO(henry) make a class with methods for loads and dumps that employ these functions
@@ -119,6 +367,8 @@ class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, PrettyOrderedSet):
             return list(obj)  # Convert PrettyOrderedSet to list
+        if isinstance(obj, type):
+            return obj.__name__  # type_changes report the old and new types
         # Let the base class default method raise the TypeError
         return json.JSONEncoder.default(self, obj)
 
@@ -0,0 +1,21 @@
+from deepdiff import DeepDiff
+from hashing import canonical_hash
+
+
+def test_equal_hashes_mean_no_differences():
+    before = {"data": [{"id": 1, "v": 2}, {"id": 2, "v": 3}], "total": 2}
+    after = {"total": 9, "data": [{"v": 3, "id": 2}, {"v": 2, "id": 1}]}
+    exclude_paths = ["root['total']"]
+    assert canonical_hash(before, exclude_paths) == canonical_hash(after, exclude_paths)
+    assert not DeepDiff(before, after, ignore_order=True, exclude_paths=exclude_paths)
+
+
+def test_no_hash_with_an_indexed_exclude_path():
+    # DeepDiff reports changes here, so equal hashes would skip a real diff
+    before = [1, [], [None, 0, "a"]]
+    after = [[None, 0, "a"], 1, []]
+    exclude_paths = ["root[0]"]
+    assert DeepDiff(before, after, ignore_order=True, exclude_paths=exclude_paths)
+    assert canonical_hash(before, exclude_paths) is None
+    assert canonical_hash(after, exclude_paths) is None
+    assert canonical_hash({"data": [1]}, ["root['data'][0]['id']"]) is None